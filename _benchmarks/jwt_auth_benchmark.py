@@ -0,0 +1,82 @@
+'''
+    Purpose: Per request JWT CPU cost of an authenticated API hit (e.g. GET `/users/create/`): the token decoded & verified by SubscriptionMiddleware,
+    APIHitLoggerMiddleware and DRF's JWTAuthentication each (before), vs once by JWTClaimsMiddleware and reused by the others (now).
+    Usage: `python _benchmarks/jwt_auth_benchmark.py --requests 20000` (from the project main dir).
+    NB: CPU only, no DB (the user lookup of the view is the same query in both cases) and no network.
+'''
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'drf_signal_simplejwt.settings')
+
+import django
+from django.conf import settings
+
+settings.DATABASES['default'].update(ENGINE='django.db.backends.sqlite3', NAME=':memory:', OPTIONS={})    # ? Never queried, only to not need a MySQL driver.
+django.setup()
+
+from django.test import RequestFactory
+from rest_framework.request import Request
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import AccessToken
+from rest_framework_simplejwt.settings import api_settings
+
+from drf_signal_simplejwt.middleware import JWTClaimsMiddleware
+from drf_signal_simplejwt.authentication import SharedJWTAuthentication
+
+
+def build_request(raw_token: str):
+    # ? SIMPLE_JWT['AUTH_HEADER_TYPES'] is ('JWT',) in this project, with any other type no token is found and nothing gets decoded.
+    return RequestFactory().get('/users/create/', HTTP_AUTHORIZATION=f'{api_settings.AUTH_HEADER_TYPES[0]} {raw_token}')
+
+
+def check_token_is_decoded(raw_token: str) -> None:
+    request = build_request(raw_token)
+    _ = JWTClaimsMiddleware(lambda request: None)(request)
+    assert request.jwt_token is not None, f'JWTClaimsMiddleware did not decode the token: {request.jwt_error}'
+    jwt_authentication = JWTAuthentication()
+    assert jwt_authentication.get_raw_token(jwt_authentication.get_header(request)) is not None, 'JWTAuthentication found no token in the header.'
+
+
+def decode_per_middleware(raw_token: str) -> None:
+    # ? As before: `AccessToken(jwt_token)` in SubscriptionMiddleware & APIHitLoggerMiddleware, then JWTAuthentication in the view.
+    request = build_request(raw_token)
+    for _ in range(2):
+        _ = AccessToken(request.META['HTTP_AUTHORIZATION'].split(' ')[1]).payload.get('user_id')
+    jwt_authentication = JWTAuthentication()
+    _ = jwt_authentication.get_validated_token(jwt_authentication.get_raw_token(jwt_authentication.get_header(request)))
+
+
+def decode_once(raw_token: str) -> None:
+    request = build_request(raw_token)
+    _ = JWTClaimsMiddleware(lambda request: None)(request)
+    for _ in range(2):
+        _ = request.jwt_token.payload.get('user_id')
+    request.jwt_user = None    # ? Skips the user query, not part of the JWT cost.
+    _ = SharedJWTAuthentication().authenticate(Request(request))
+
+
+def run(handle_request, raw_token: str, requests_count: int) -> float:
+    started_at = time.perf_counter()
+    for _ in range(requests_count):
+        handle_request(raw_token)
+    return time.perf_counter() - started_at
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per request JWT decoding cost, per middleware vs once.')
+    parser.add_argument('--requests', type=int, default=20000)
+    args = parser.parse_args()
+
+    access_token = AccessToken()
+    access_token['user_id'] = 1
+    raw_token: str = str(access_token)
+    check_token_is_decoded(raw_token)    # ? Before timing, else both paths could be measuring nothing.
+
+    for label, handle_request in (('3 decodes', decode_per_middleware), ('1 decode', decode_once)):
+        elapsed_secs = run(handle_request, raw_token, args.requests)
+        print(f'{label:>10} ---> {args.requests} requests in {elapsed_secs:.2f}s, {elapsed_secs / args.requests * 1e6:.1f} µs per request')
@@ -0,0 +1,72 @@
+'''
+    Purpose: Per request cost of the internal IP in the middleware stack: `socket.gethostbyname(socket.gethostname())` in APIHitLoggerMiddleware
+    and CaptureIPMiddleware plus CaptureIPMiddleware's prints (before), vs `get_internal_ip()` resolved once per process and a debug log (now).
+    Usage: `python _benchmarks/middleware_ip_benchmark.py --requests 20000` (from the project main dir).
+    NB: The lookup cost depends on the host's resolver (/etc/hosts, nscd, DNS), measure on the deployment host. No DB, no network besides the lookup.
+'''
+
+import os
+import sys
+import time
+import socket
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'drf_signal_simplejwt.settings')
+
+import django
+from django.conf import settings
+
+settings.DATABASES['default'].update(ENGINE='django.db.backends.sqlite3', NAME=':memory:', OPTIONS={})    # ? Never queried, only to not need a MySQL driver.
+django.setup()
+
+from django.test import RequestFactory
+
+from drf_signal_simplejwt.middleware import CaptureIPMiddleware
+from drf_signal_simplejwt.base_functions import get_internal_ip
+
+
+def build_request():
+    return RequestFactory().get('/users/create/', HTTP_X_FORWARDED_FOR='203.0.113.7, 10.0.0.2')
+
+
+def resolve_per_request() -> None:
+    # ? As before: one lookup in APIHitLoggerMiddleware, one lookup and two prints in CaptureIPMiddleware.
+    request = build_request()
+    _ = socket.gethostbyname(socket.gethostname())
+    local_ip = socket.gethostbyname(socket.gethostname())
+    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+    external_ip = x_forwarded_for.split(',')[0] if x_forwarded_for else request.META.get('REMOTE_ADDR')
+    request.local_ip, request.external_ip = local_ip, external_ip
+    print('local_ip---------------->', local_ip)
+    print('external_ip---------------->', external_ip)
+
+
+capture_ip_middleware = CaptureIPMiddleware(lambda request: None)
+
+
+def resolve_once() -> None:
+    request = build_request()
+    _ = get_internal_ip()
+    _ = capture_ip_middleware(request)
+
+
+def run(handle_request, requests_count: int) -> float:
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):    # ? Prints still cost a write, not a terminal redraw.
+        started_at = time.perf_counter()
+        for _ in range(requests_count):
+            handle_request()
+        return time.perf_counter() - started_at
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per request internal IP cost, resolved per request vs once per process.')
+    parser.add_argument('--requests', type=int, default=20000)
+    args = parser.parse_args()
+
+    get_internal_ip()    # ? Warm up, the first call resolves.
+
+    for label, handle_request in (('per request', resolve_per_request), ('cached', resolve_once)):
+        elapsed_secs = run(handle_request, args.requests)
+        print(f'{label:>12} ---> {args.requests} requests in {elapsed_secs:.2f}s, {elapsed_secs / args.requests * 1e6:.1f} µs per request')
@@ -0,0 +1,107 @@
+'''
+    Purpose: Compare the outbox relay publish throughput of the legacy AMQP transaction path, the publisher confirms window path (sync engine)
+    and the asyncio engine (`--engine=async`, needs aio-pika).
+    Usage: `python _benchmarks/outbox_publish_benchmark.py --messages 5000 --window 500` (from the project main dir, RabbitMQ configured in settings.py / .env).
+    A local RabbitMQ stand-in is enough, e.g. `docker run --rm -p 5672:5672 -e RABBITMQ_DEFAULT_VHOST=drf_vhost -e RABBITMQ_DEFAULT_USER=drf_user -e RABBITMQ_DEFAULT_PASS=drf_user rabbitmq:3`.
+    NB: Messages are published to a throwaway `outbox_benchmark_queue`, which is purged before and after every run. MySQL is not touched.
+'''
+
+import os
+import sys
+import time
+import uuid
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'drf_signal_simplejwt.settings')
+
+import producer_service
+
+
+BENCHMARK_QUEUE_NAME: str = 'outbox_benchmark_queue'
+BENCHMARK_EXCHANGE_NAME: str = 'outbox_benchmark_exchange'
+
+
+def build_records(count: int) -> list:
+    return [
+        {
+            'id': i
+            , 'queue_name': BENCHMARK_QUEUE_NAME
+            , 'exchange_name': BENCHMARK_EXCHANGE_NAME
+            , 'deadletter_queue_name': BENCHMARK_QUEUE_NAME + '_DLQ'
+            , 'deadletter_exchange_name': BENCHMARK_EXCHANGE_NAME + '_DLX'
+            , 'message_body_json': '{"username": "benchmark_user_%s", "is_created": true}' % i
+            , 'delivery_mode': 2
+            , 'expiration_secs': 60
+            , 'message_id': str(uuid.uuid4())
+        }
+        for i in range(1, count + 1)
+    ]
+
+
+def purge_benchmark_queue() -> None:
+    connection, channel = producer_service.connect_to_rabbitmq()
+    try:
+        channel.queue_purge(queue=BENCHMARK_QUEUE_NAME)
+    except Exception:
+        pass    # ? Queue is declared by the first publish.
+    finally:
+        if connection.is_open:
+            connection.close()
+
+
+def run(publish_window_func, records: list, window_size: int) -> float:
+    purge_benchmark_queue()
+    started_at = time.perf_counter()
+    published_count = 0
+    for window_start in range(0, len(records), window_size):
+        publish_results = publish_window_func(records[window_start: window_start + window_size])
+        published_count += sum(1 for status, _ in publish_results.values() if status == 'published')
+    elapsed_secs = time.perf_counter() - started_at
+    purge_benchmark_queue()
+    assert published_count == len(records), f'Only {published_count}/{len(records)} messages were published.'
+    return elapsed_secs
+
+
+def run_async_engine(records: list, window_size: int) -> float:
+    import producer_service_async
+
+    async def publish_all() -> int:
+        rabbitmq_connection = await producer_service_async.connect_to_rabbitmq_async()
+        channel = await rabbitmq_connection.channel(publisher_confirms=True)
+        declared_exchanges: dict = {}
+        in_flight_semaphore = asyncio.Semaphore(producer_service_async.OUTBOX_ASYNC_MAX_IN_FLIGHT)
+        # ? Windows are published concurrently, like the async engine does with consecutive claimed batches.
+        windows_results: list = await asyncio.gather(*(
+                                        producer_service_async.publish_window_async(channel, declared_exchanges, records[window_start: window_start + window_size], in_flight_semaphore)
+                                        for window_start in range(0, len(records), window_size)
+                                    ))
+        await rabbitmq_connection.close()
+        return sum(1 for publish_results in windows_results for status, _ in publish_results.values() if status == 'published')
+
+    purge_benchmark_queue()
+    started_at = time.perf_counter()
+    published_count = asyncio.run(publish_all())
+    elapsed_secs = time.perf_counter() - started_at
+    purge_benchmark_queue()
+    assert published_count == len(records), f'Only {published_count}/{len(records)} messages were published.'
+    return elapsed_secs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Outbox relay publish throughput: tx vs confirm mode.')
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--window', type=int, default=producer_service.PUBLISH_CONFIRM_WINDOW)
+    args = parser.parse_args()
+
+    records = build_records(args.messages)
+    for mode, publish_window_func in (('tx', producer_service.publish_window_with_transactions), ('confirm', producer_service.publish_window_with_confirms)):
+        elapsed_secs = run(publish_window_func, records, args.window)
+        print(f'{mode:>8} ---> {args.messages} msgs in {elapsed_secs:.2f}s, {args.messages / elapsed_secs:,.0f} msgs/sec')
+
+    try:
+        elapsed_secs = run_async_engine(records, args.window)
+        print(f'{"async":>8} ---> {args.messages} msgs in {elapsed_secs:.2f}s, {args.messages / elapsed_secs:,.0f} msgs/sec')
+    except ImportError as e:
+        print(f'{"async":>8} ---> skipped, {e}')
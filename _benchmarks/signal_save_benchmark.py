@@ -0,0 +1,75 @@
+'''
+    Purpose: `UserDetail.save()` throughput without the user sync post_save signal, with it in 'full' and in 'diff' payload mode,
+    and the cost of building the message body with `deepcopy(instance.__dict__)` vs the precomputed field extractor.
+    Usage: `python _benchmarks/signal_save_benchmark.py --saves 2000` (from the project main dir).
+    NB: Runs on a throwaway in-memory SQLite DB, tables created with syncdb. MySQL and RabbitMQ are not touched (relay nudges disabled).
+'''
+
+import os
+import sys
+import time
+import argparse
+import timeit
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'drf_signal_simplejwt.settings')
+os.environ['OUTBOX_WAKEUP_PORT'] = '0'
+
+import django
+from django.conf import settings
+
+settings.DATABASES['default'].update(ENGINE='django.db.backends.sqlite3', NAME=':memory:', OPTIONS={})
+settings.MIGRATION_MODULES = {app.split('.')[-1]: None for app in settings.INSTALLED_APPS}    # ? syncdb every app, no migrations are shipped.
+django.setup()
+
+from django.core.management import call_command
+from django.db.models.signals import post_save
+
+from users.models import UserDetail
+from users import signals as user_signals
+from pubsub.models import QueuePublishHistory
+
+
+def run_saves(user, saves: int) -> float:
+    started_at = time.perf_counter()
+    for i in range(saves):
+        user.phone_no = str(i).zfill(10)
+        user.save()
+    return time.perf_counter() - started_at
+
+
+def build_body_with_deepcopy(instance) -> dict:
+    # ? The message body as built before the field extractor.
+    copied_user_instance_dict: dict = deepcopy(instance.__dict__)
+    copied_user_instance_dict.pop('_state', None)
+    copied_user_instance_dict.pop('_django_version', None)
+    return copied_user_instance_dict
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='UserDetail.save() throughput with and without the user sync signal.')
+    parser.add_argument('--saves', type=int, default=2000)
+    args = parser.parse_args()
+
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    user = UserDetail.objects.create(username='benchmark_user', first_name='Bench', last_name='Mark', email='bench@mark.local')
+
+    results: dict = {}
+    post_save.disconnect(user_signals.create_entry_queue_publish_history_user_post_creation, sender=UserDetail)
+    results['no signal'] = run_saves(user, args.saves)
+    post_save.connect(user_signals.create_entry_queue_publish_history_user_post_creation, sender=UserDetail)
+
+    for payload_mode in ('full', 'diff'):
+        settings.RABBITMQ['USER_SYNC_PAYLOAD_MODE'] = payload_mode
+        user = UserDetail.objects.get(pk=user.pk)    # ? Reloaded, so post_init tracks the original values in 'diff' mode.
+        results[f'signal, {payload_mode}'] = run_saves(user, args.saves)
+
+    for label, elapsed_secs in results.items():
+        print(f'{label:>14} ---> {args.saves} saves in {elapsed_secs:.2f}s, {args.saves / elapsed_secs:,.0f} saves/sec')
+    print(f'{"outbox rows":>14} ---> {QueuePublishHistory.objects.count()}')
+
+    user = UserDetail.objects.get(pk=user.pk)
+    for label, build_body in (('deepcopy', build_body_with_deepcopy), ('extractor', user_signals.get_loaded_user_field_values)):
+        per_call_secs = min(timeit.repeat(lambda: build_body(user), number=10000, repeat=3)) / 10000
+        print(f'{label:>14} ---> {per_call_secs * 1e6:.1f} µs per message body')
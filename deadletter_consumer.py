@@ -1,6 +1,4 @@
 
-### ! NB: RESTART THIS SCRIPT IF MYSQL CONNECTION WAS TEMPORARILY DOWN. OTHERWISE, IT WILL NOT BE ABLE TO FETCH THE QUEUE NAMES FROM THE DB.
-
 import os
 import time
 
@@ -8,14 +6,17 @@ import django
 import pika
 from AshLogger import AshLogger
 from django.conf import settings
-from django.db import transaction
+from django.db import transaction, close_old_connections
+from django.db.models import Case, When, Value, F
+from django.db.models.expressions import RawSQL
 
 
 # Set the DJANGO_SETTINGS_MODULE environment variable to your project's settings.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'drf_signal_simplejwt.settings')
 django.setup()
 
-from pubsub.models import QueuePublishHistory    # Ordering of import matters, this import should be after the django.setup() call and setting the DJANGO_SETTINGS_MODULE environment variable.
+from pubsub.models import QueuePublishHistory, DeadLetterQueue    # Ordering of import matters, this import should be after the django.setup() call and setting the DJANGO_SETTINGS_MODULE environment variable.
+from pubsub.retry import OUTBOX_MAX_ATTEMPTS, NEXT_ATTEMPT_AT_SQL, NEXT_ATTEMPT_AT_PARAMS
 
 logger_obj = AshLogger(file_name='deadletter_consumer.log', file_location=os.path.join(settings.BASE_DIR, 'logs'), max_bytes=10000000, max_backups=1)
 ash_logger = logger_obj.setup_logger()
@@ -32,23 +33,78 @@ RABBITMQ_PASSWORD = settings.RABBITMQ['PASSWORD']
 SLEEP_INTERVAL: int = 10
 
 
-dead_letter_queue_names: list = list(QueuePublishHistory.objects.values_list('deadletter_queue_name', flat=True).distinct())
+PREFETCH_COUNT: int = int(os.environ.get('DEADLETTER_PREFETCH_COUNT', 500))    # Max. unacked deadletter messages delivered to this consumer at once.
+EXPIRY_BATCH_SIZE: int = min(int(os.environ.get('DEADLETTER_EXPIRY_BATCH_SIZE', 200)), PREFETCH_COUNT)    # ? message_ids marked expired with one UPDATE. Can't exceed the prefetch window, the broker would stop delivering.
+EXPIRY_FLUSH_INTERVAL_SECS: float = float(os.environ.get('DEADLETTER_EXPIRY_FLUSH_INTERVAL_SECS', 1))    # A partial batch is flushed after this, so a lone message is not delayed for long.
+DEADLETTER_QUEUES_REFRESH_SECS: int = int(os.environ.get('DEADLETTER_QUEUES_REFRESH_SECS', 30))    # ? The DeadLetterQueue registry is polled this often for queues registered after startup.
+
+
+class ExpiryBatcher:
+    '''
+    Buffers the message_ids of the deadletter messages of a channel and marks them expired with a single `UPDATE ... WHERE message_id IN (...)`
+    per EXPIRY_BATCH_SIZE messages (or EXPIRY_FLUSH_INTERVAL_SECS), then acks them all with one `basic_ack(multiple=True)` after the commit.
+    Messages are delivered in delivery tag order on a channel, so every tag up to the last one of the batch is covered by the commit.
+    If the UPDATE fails, nothing is acked and the whole batch is redelivered after the reconnect, marking a row expired twice is harmless.
+    '''
+
+    def __init__(self, channel, batch_size: int = EXPIRY_BATCH_SIZE, flush_interval_secs: float = EXPIRY_FLUSH_INTERVAL_SECS):
+        self.channel = channel
+        self.batch_size = batch_size
+        self.flush_interval_secs = flush_interval_secs
+        self.message_ids: list = []
+        self.last_delivery_tag = None
+        self.flush_timer = None
+
+    def add(self, delivery_tag: int, message_id: str) -> None:
+        if message_id:
+            self.message_ids.append(message_id)
+        self.last_delivery_tag = delivery_tag    # ? Messages without a message_id have no row to mark, only acked with the batch.
+        if len(self.message_ids) >= self.batch_size:
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = self.channel.connection.call_later(self.flush_interval_secs, self._on_flush_timer)
+
+    def _on_flush_timer(self) -> None:
+        self.flush_timer = None
+        self.flush()
+
+    def flush(self) -> None:
+        if self.flush_timer is not None:
+            self.channel.connection.remove_timeout(self.flush_timer)
+            self.flush_timer = None
+        message_ids, self.message_ids = self.message_ids, []
+        last_delivery_tag, self.last_delivery_tag = self.last_delivery_tag, None
+        if last_delivery_tag is None:
+            return
+
+        if message_ids:
+            with transaction.atomic():
+                # * Counts as a failed attempt: republished after a backoff, `failed` once out of attempts (pubsub/retry.py).
+                expired_count: int = QueuePublishHistory.objects.filter(message_id__in=message_ids).update(
+                                                                status=Case(When(attempt_count__gte=OUTBOX_MAX_ATTEMPTS - 1, then=Value('failed')), default=Value('expired'))
+                                                                , next_attempt_at=RawSQL(NEXT_ATTEMPT_AT_SQL, NEXT_ATTEMPT_AT_PARAMS)
+                                                                , attempt_count=F('attempt_count') + 1    # ! Keep it last, MySQL assigns left to right and the others must read the old value.
+                                                            )
+            ash_logger.info(f" [x] Marked {expired_count} rows expired for {len(message_ids)} Expired / Rejected msgs, delivery tags up to {last_delivery_tag}.")
+
+        self.channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)    # Manually acknowledge the messages. So, that the same messages are not delivered again by the message broker and they will be removed from the queue.
+
+
+expiry_batchers: dict = {}    # ? channel number -> ExpiryBatcher
+
+
+def get_expiry_batcher(channel) -> ExpiryBatcher:
+    if channel.channel_number not in expiry_batchers or expiry_batchers[channel.channel_number].channel is not channel:
+        expiry_batchers[channel.channel_number] = ExpiryBatcher(channel)
+    return expiry_batchers[channel.channel_number]
 
 
 # * Callback function to handle incoming messages.
 def callback(ch, method, properties, body):
-    message_id = properties.message_id
-    ash_logger.info(f"Marking message_id: '{message_id}' as expired in DB.")
-    with transaction.atomic():
-        _ = QueuePublishHistory.objects.filter(message_id=message_id).update(status='expired')
-
     # # Get the queue name from the method_frame
     # queue_name = method.routing_key
 
-    # print(f" [x] Received Expired / Rejected msg: {body}, of type: {type(body)}")
-    ash_logger.info(f" [x] Received Expired / Rejected msg: {body}, of type: {type(body)}")
-
-    ch.basic_ack(delivery_tag=method.delivery_tag)    # Manually acknowledge the message. So, that the same message is not delivered again by the message broker and it will be removed from the queue.
+    get_expiry_batcher(ch).add(method.delivery_tag, properties.message_id)    # * Marked expired & acked with the rest of its batch.
     # ch.basic_reject(delivery_tag = method.delivery_tag, requeue=True)    # Manually reject the message.
 
 
@@ -90,30 +146,48 @@ def connect_to_rabbitmq():
 
 
 
+def subscribe_to_new_deadletter_queues(channel, consumed_queue_names: set) -> None:
+    '''
+    Declares & consumes the queues of the DeadLetterQueue registry not consumed yet on this channel, then schedules itself again on the connection's ioloop.
+    Small indexed table, so startup and refreshes no longer depend on the size of `queue_publish_history`.
+    '''
+    if not channel.is_open:
+        return
+    try:
+        close_old_connections()    # ? Long running process, drops the DB connection if it went stale in between.
+        registered_queue_names: list = list(DeadLetterQueue.objects.values_list('queue_name', flat=True))
+    except Exception as e:
+        ash_logger.info(f"Error while fetching the deadletter queues -----> {str(e)}")
+        registered_queue_names = []
+
+    for queue_name in registered_queue_names:
+        if queue_name in consumed_queue_names:
+            continue
+        channel.queue_declare(queue=queue_name, durable=True)    # ? durable=True: The queue will survive server restarts. Durable queues do not necessarily hold persistent messages, although it does not make sense to send persistent messages to a transient queue.
+        channel.basic_consume(queue=queue_name, on_message_callback=callback)
+        consumed_queue_names.add(queue_name)
+        ash_logger.info(f" [*] Consuming deadletter queue '{queue_name}'.")
+
+    channel.connection.call_later(DEADLETTER_QUEUES_REFRESH_SECS, lambda: subscribe_to_new_deadletter_queues(channel, consumed_queue_names))
+
+
 def consume_deadletter_msg_from_rabbitmq():
     try:
 
         connection, channel = connect_to_rabbitmq()
 
-        # * Declare the queue again to ensure it exists.
-        for queue_name in dead_letter_queue_names:
-            channel.queue_declare(queue=queue_name, durable=True)    # ? durable=True: The queue will survive server restarts. Durable queues do not necessarily hold persistent messages, although it does not make sense to send persistent messages to a transient queue.
-
 
         '''
-        Consumer will only consume 1 message at a time. 
         It is the maximum number of unacknowledged messages (or "unacked" messages) that a consumer can receive from a queue at a time.
         It sets a "quality of service" (QoS) limit for message consumption.
-        Setting prefetch_count=1 ensures that each consumer receives one message at a time, allowing for a fair distribution of messages among multiple consumers.
-        This is especially useful when you have multiple consumers (workers) competing for messages from the same queue.
-        It prevents one consumer from hogging all the messages while others remain idle.
+        After a TTL expiry wave thousands of messages are deadlettered at once, a window of PREFETCH_COUNT messages lets them be marked expired
+        and acked in batches (see ExpiryBatcher) instead of one broker round trip and one transaction per message.
         '''
-        channel.basic_qos(prefetch_count=1)
+        channel.basic_qos(prefetch_count=PREFETCH_COUNT)
 
 
-        # * Set up a consumer to listen for messages in the `queue_name` queue
-        for queue_name in dead_letter_queue_names:
-            channel.basic_consume(queue=queue_name, on_message_callback=callback)
+        # * Declare the registered deadletter queues again to ensure they exist and set up a consumer on each of them. New ones are picked up at runtime.
+        subscribe_to_new_deadletter_queues(channel, set())
         # channel.basic_consume(queue=queue_name, auto_ack=True, on_message_callback=lambda ch, method, properties, body: print(f'Received new msg: {body}'))
 
 
@@ -0,0 +1,80 @@
+import atexit
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from users.models import UserAPIHitLog
+
+
+logger = logging.getLogger(__name__)
+
+
+class APIHitLogBuffer:
+    '''
+    Bounded in-memory ring buffer of UserAPIHitLog rows, written by a background thread with one `bulk_create` per `flush_size` rows or every
+    `flush_interval_ms`, so APIHitLoggerMiddleware no longer adds an INSERT to the latency of every API call.
+    When full (DB down or too slow) the oldest hits are overwritten and counted as dropped (logged with the next flush), instead of blocking the
+    requests or growing the memory. Rows failing to be written are dropped the same way. Drained on graceful shutdown (atexit).
+    NB: Per process. The writer thread is started by the first hit, so after a fork (gunicorn --preload) every worker gets its own.
+    '''
+
+    def __init__(self, max_size: int, flush_size: int, flush_interval_ms: int):
+        self.hits: deque = deque(maxlen=max_size)
+        self.flush_size = flush_size
+        self.flush_interval_secs: float = flush_interval_ms / 1000
+        self.condition = threading.Condition()
+        self.dropped_count: int = 0
+        self.writer_thread = None
+        self.stopping: bool = False
+
+    def add(self, hit: UserAPIHitLog) -> None:
+        with self.condition:
+            if len(self.hits) == self.hits.maxlen:
+                self.dropped_count += 1    # ? The oldest hit is evicted by the append.
+            self.hits.append(hit)
+            if self.writer_thread is None:
+                self.writer_thread = threading.Thread(target=self._write_hits, name='api-hit-log-writer', daemon=True)
+                self.writer_thread.start()
+            if len(self.hits) >= self.flush_size:
+                self.condition.notify()
+
+    def stop(self, timeout_secs: float = 10) -> None:
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.writer_thread is not None:
+            self.writer_thread.join(timeout_secs)
+
+    def _write_hits(self) -> None:
+        while True:
+            with self.condition:
+                if len(self.hits) < self.flush_size and not self.stopping:
+                    self.condition.wait(self.flush_interval_secs)
+                hits: list = [self.hits.popleft() for _ in range(min(self.flush_size, len(self.hits)))]
+                stopping: bool = self.stopping and not self.hits
+                dropped_count, self.dropped_count = self.dropped_count, 0
+
+            if hits:
+                close_old_connections()    # ? This thread's own DB connection, dropped if it went stale in between.
+                try:
+                    _ = UserAPIHitLog.objects.bulk_create(hits)
+                except Exception as e:
+                    logger.error(f'Could not write {len(hits)} API hit logs -----> {str(e)}')
+                    dropped_count += len(hits)
+            if dropped_count:
+                logger.warning(f'{dropped_count} API hit logs dropped.')
+
+            if stopping:
+                connection.close()
+                return
+
+
+api_hit_log_buffer = APIHitLogBuffer(
+                            max_size=settings.API_HIT_LOG_BUFFER_SIZE
+                            , flush_size=settings.API_HIT_LOG_FLUSH_SIZE
+                            , flush_interval_ms=settings.API_HIT_LOG_FLUSH_INTERVAL_MS
+                        )
+atexit.register(api_hit_log_buffer.stop)    # * Drains the buffer on graceful shutdown.
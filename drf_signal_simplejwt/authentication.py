@@ -0,0 +1,22 @@
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+
+class SharedJWTAuthentication(JWTAuthentication):
+    '''
+    JWTAuthentication reusing the token already verified by JWTClaimsMiddleware (`request.jwt_token`), instead of decoding and verifying it a 3rd time.
+    The user of the token is fetched once per request and kept on the request. Without the middleware it is plain JWTAuthentication.
+    '''
+
+    def authenticate(self, request):
+        django_request = request._request
+        if not hasattr(django_request, 'jwt_token'):
+            return super().authenticate(request)
+
+        if django_request.jwt_error is not None:
+            raise django_request.jwt_error    # ? Same InvalidToken / AuthenticationFailed JWTAuthentication would have raised.
+        if django_request.jwt_token is None:
+            return None    # No (Bearer) token, let the other authentication classes try.
+
+        if not hasattr(django_request, 'jwt_user'):
+            django_request.jwt_user = self.get_user(django_request.jwt_token)
+        return django_request.jwt_user, django_request.jwt_token
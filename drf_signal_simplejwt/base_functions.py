@@ -1,6 +1,8 @@
 import os
 import json
+import socket
 import datetime
+import threading
 
 from django.conf import settings
 from django.core.serializers.json import DjangoJSONEncoder
@@ -41,3 +43,68 @@ class ConvertObjsJSONEncoder(DjangoJSONEncoder):
             return obj.url if obj else None
         return super().default(obj)
 
+
+
+_field_extractors: dict = {}    # ? model class -> extract(instance)
+
+
+def get_field_extractor(model):
+    '''
+    Returns `extract(instance) -> dict` of the concrete field values of a `model` instance, by attname (`college_id`, not `college`), as stored in `instance.__dict__`.
+    The attnames are computed once per model from `_meta.concrete_fields`. Cheaper than `deepcopy(instance.__dict__)`, which also copies `_state`
+    (and the related objects cached in it) and any other private attribute (e.g. the raw password kept by `set_password()`), only to drop them.
+    NB: Shallow, mutable values (JSONField) are shared with the instance. Deferred fields are skipped, reading them would cost a query.
+    '''
+    if model not in _field_extractors:
+        attnames: tuple = tuple(field.attname for field in model._meta.concrete_fields)
+
+        def extract(instance) -> dict:
+            instance_dict: dict = instance.__dict__
+            return {attname: instance_dict[attname] for attname in attnames if attname in instance_dict}
+
+        _field_extractors[model] = extract
+    return _field_extractors[model]
+
+
+_internal_ip = None
+_internal_ip_lock = threading.Lock()
+
+
+def resolve_internal_ip() -> str:
+    try:
+        return socket.gethostbyname(socket.gethostname())    # ? Internal/local IP address of this host, a DNS / hosts file lookup.
+    except OSError:
+        return '127.0.0.1'
+
+
+def refresh_internal_ip() -> None:
+    # ? Resolves the internal IP again, then every INTERNAL_IP_REFRESH_SECS on a daemon timer (0 disables the timer). Can also be called directly, e.g. after a network change.
+    global _internal_ip
+    _internal_ip = resolve_internal_ip()
+    if settings.INTERNAL_IP_REFRESH_SECS:
+        refresh_timer = threading.Timer(settings.INTERNAL_IP_REFRESH_SECS, refresh_internal_ip)
+        refresh_timer.daemon = True
+        refresh_timer.start()
+
+
+def get_internal_ip() -> str:
+    '''
+    Internal IP of this host, resolved once per process instead of `socket.gethostbyname(socket.gethostname())` on every request,
+    which costs milliseconds on hosts with slow resolvers. Kept fresh by refresh_internal_ip().
+    '''
+    global _internal_ip
+    if _internal_ip is None:
+        with _internal_ip_lock:
+            if _internal_ip is None:
+                refresh_internal_ip()
+    return _internal_ip
+
+
+def _reset_internal_ip_after_fork() -> None:
+    # ? The refresh timer thread doesn't survive a fork (gunicorn --preload), the child resolves again and starts its own.
+    global _internal_ip, _internal_ip_lock
+    _internal_ip, _internal_ip_lock = None, threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):    # ? Unix only, there is no fork on Windows.
+    os.register_at_fork(after_in_child=_reset_internal_ip_after_fork)
@@ -1,22 +1,26 @@
 
 # ? Register this middleware under the MIDDLEWARE list in settings.py.
 
-from users import models as user_models
-from master.models import CollegePlanMapping
+from master.entitlements import get_user_entitlement, is_college_plan_active
 from users.models import UserAPIHitLog
+from drf_signal_simplejwt.api_hit_log_buffer import api_hit_log_buffer
+from drf_signal_simplejwt.base_functions import get_internal_ip
 
 from django.http import JsonResponse
 from django.contrib.auth.models import AnonymousUser
 from rest_framework.exceptions import APIException
-from rest_framework_simplejwt.tokens import AccessToken
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, AuthenticationFailed
 from django_user_agents.utils import get_user_agent
 
 from ipware import get_client_ip
 
 from pprint import pprint
-from datetime import date
 import fnmatch
-import socket
+import logging
+
+
+logger = logging.getLogger(__name__)
 
 
 
@@ -27,6 +31,32 @@ def is_excluded_path(path: str, excluded_paths: list) -> bool:
     return False
 
 
+class JWTClaimsMiddleware:
+    '''
+    Decodes & verifies the JWT of the request once, for SubscriptionMiddleware, APIHitLoggerMiddleware and the DRF views (SharedJWTAuthentication),
+    instead of once each. Register it before them. Sets on the request:
+        - `jwt_token`: the validated AccessToken, None if there is no token (of a SIMPLE_JWT['AUTH_HEADER_TYPES'] type) or if it didn't verify.
+        - `jwt_error`: the InvalidToken / AuthenticationFailed raised by the verification, else None.
+    '''
+    jwt_authentication = JWTAuthentication()
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.jwt_token, request.jwt_error = None, None
+        try:
+            header = self.jwt_authentication.get_header(request)
+            raw_token = self.jwt_authentication.get_raw_token(header) if header is not None else None
+            if raw_token is not None:
+                request.jwt_token = self.jwt_authentication.get_validated_token(raw_token)
+        except (InvalidToken, AuthenticationFailed) as e:
+            request.jwt_error = e
+
+        response = self.get_response(request)
+        return response
+
+
 def SubscriptionMiddleware(get_response):
     def middleware(request):
         # print('requst.path---------------->', request.path)
@@ -41,43 +71,27 @@ def SubscriptionMiddleware(get_response):
 
             # if not isinstance(request.user, AnonymousUser):
             # if str(request.user) != 'AnonymousUser':
-            jwt_token = request.META.get('HTTP_AUTHORIZATION', None)
-            if jwt_token:
-                jwt_token = jwt_token.split(' ')[1]
-                # try:
-                access_token = AccessToken(jwt_token)
-                user = access_token.payload.get('user_id')    # int
+            if request.jwt_error is not None:
+                return JsonResponse({'error': 'Invalid JWT token.'}, status=401)
+            if request.jwt_token is not None:    # ? Verified once by JWTClaimsMiddleware.
+                user = request.jwt_token.payload.get('user_id')    # int
                 print('User ID from AccessToken for SubscriptionMiddleware ----------> ', user)
 
-                user_obj = user_models.UserDetail.objects.get(id=user)
-                if not user_obj.is_superuser:    # If user is a superuser and request is coming from an API hit, with Knox token.
-                    user_college_obj = user_obj.college if user_obj.college else None
-                    college_plan_mapping_obj = CollegePlanMapping.objects.get(college=user_college_obj) if user_college_obj else None
-                    if not college_plan_mapping_obj:
+                user_entitlement = get_user_entitlement(user)    # * Cached, see master/entitlements.py. No query in the steady state.
+                if not user_entitlement['is_superuser']:    # If user is a superuser and request is coming from an API hit, with Knox token.
+                    if not user_entitlement['college_id']:
                         response_data = {
                             'error': f'College is not assigned to user with id: {user}.'
                         }
                         return JsonResponse(response_data, status=403)
-                    # print('is_active::: ', not college_plan_mapping_obj.is_active)
-                    # print('valid date expired::: ', college_plan_mapping_obj.plan_valid_until and (college_plan_mapping_obj.plan_valid_until.date() < date.today()))
-                    # print('trial date expired::: ', college_plan_mapping_obj.is_trial and college_plan_mapping_obj.trial_end_date and (college_plan_mapping_obj.trial_end_date.date() < date.today()))
-                    # print('is_cancelled::: ', college_plan_mapping_obj.is_cancelled)
-                    # Check if the subscription has expired
-                    if (
-                        not college_plan_mapping_obj.is_active                                                                                                                  # * not is_active
-                        or (college_plan_mapping_obj.plan_valid_until and college_plan_mapping_obj.plan_valid_until.date() < date.today())                                      # * or plan_valid_until
-                        or (college_plan_mapping_obj.is_trial and college_plan_mapping_obj.trial_end_date and college_plan_mapping_obj.trial_end_date.date() < date.today())    # * or is_trial & trial_end_date
-                        or college_plan_mapping_obj.is_cancelled                                                                                                                # * or is_cancelled
-                    ):
+                    # Check if the subscription has expired: not is_active, or plan_valid_until / trial_end_date passed, or is_cancelled. See get_plan_verdict().
+                    if not is_college_plan_active(user_entitlement['college_id']):
                         # Subscription has expired
                         response_data = {
                             'error': 'Subscription has expired. Please renew your subscription.'
                         }
                         return JsonResponse(response_data, status=403)
 
-                # except:
-                #     return JsonResponse({'error': 'Invalid JWT token'}, status=401)
-
             else:
                 response_data = {
                     'error': '403 Forbidden.'
@@ -140,12 +154,8 @@ class APIHitLoggerMiddleware:
 
     def __call__(self, request):
         if not is_excluded_path(request.path, self.EXCLUDED_PATHS) and not request.user.is_superuser:
-            jwt_token = request.META.get('HTTP_AUTHORIZATION', None)
-            if jwt_token:
-                jwt_token = jwt_token.split(' ')[1]
-                # try:
-                access_token = AccessToken(jwt_token)
-                user_id = access_token.payload.get('user_id')    # int
+            if request.jwt_token is not None:    # ? Verified once by JWTClaimsMiddleware.
+                user_id = request.jwt_token.payload.get('user_id')    # int
                 print('User ID from AccessToken for APIHitLoggerMiddleware ----------> ', user_id)
 
 
@@ -153,11 +163,11 @@ class APIHitLoggerMiddleware:
                 user_agent = get_user_agent(request)
                 browser_name = user_agent.browser.family
                 os_name = user_agent.os.family
-                internal_ip = socket.gethostbyname(socket.gethostname())    # Get internal/local IP address (if behind a proxy)
+                internal_ip = get_internal_ip()    # Get internal/local IP address (if behind a proxy). Resolved once per process, not per request.
                 external_ip = self.get_client_ip(request)    # Get remote/external/static IP address
                 # Get MAC address (not possible via HTTP request)
 
-                _ = UserAPIHitLog.objects.create(
+                api_hit_log_buffer.add(UserAPIHitLog(    # * Written in bulk by a background thread, off the request path.
                                             # user_id=request.user.id,
                                             user_id=user_id,
                                             api_name=request.path,
@@ -165,7 +175,7 @@ class APIHitLoggerMiddleware:
                                             external_ip=external_ip,
                                             browser_name=browser_name,
                                             os_name=os_name,
-                    )
+                    ))
 
         response = self.get_response(request)
         return response
@@ -187,7 +197,7 @@ class CaptureIPMiddleware:
 
     def __call__(self, request):
         # Get the client's local network IP
-        local_ip = socket.gethostbyname(socket.gethostname())
+        local_ip = get_internal_ip()    # ? Resolved once per process, not per request.
         # local_ip, _ = get_client_ip(request)
 
         # Get the client's external static IP
@@ -201,8 +211,7 @@ class CaptureIPMiddleware:
         request.local_ip = local_ip
         request.external_ip = external_ip
 
-        print('local_ip---------------->', local_ip)
-        print('external_ip---------------->', external_ip)
+        logger.debug(f'local_ip: {local_ip}, external_ip: {external_ip}')
 
         response = self.get_response(request)
         return response
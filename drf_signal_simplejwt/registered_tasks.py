@@ -12,6 +12,7 @@ from background_task.models import Task
 
 # Import the tasks functions here and register them in the function registered_tasks().
 from users.tasks import test_task
+from pubsub.tasks import archive_published_queue_history_task, purge_processed_messages_task
 
 
 def registered_tasks():
@@ -22,4 +23,6 @@ def registered_tasks():
 
     # test_task(repeat=10)
     test_task(schedule=midnight_time.replace(hour=0, minute=0, second=0, microsecond=0), repeat=Task.DAILY)    # Runs daily at 00:00:00.
+    archive_published_queue_history_task(schedule=midnight_time.replace(hour=2, minute=0, second=0, microsecond=0), repeat=Task.DAILY)    # Runs daily at 02:00:00.
+    purge_processed_messages_task(schedule=midnight_time.replace(hour=2, minute=30, second=0, microsecond=0), repeat=Task.DAILY)    # Runs daily at 02:30:00.
 
@@ -82,6 +82,7 @@ MIDDLEWARE = [
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     'corsheaders.middleware.CorsMiddleware',
+    'drf_signal_simplejwt.middleware.JWTClaimsMiddleware',    # ? Before the middlewares reading `request.jwt_token`.
     'drf_signal_simplejwt.middleware.SubscriptionMiddleware',
     'drf_signal_simplejwt.middleware.APIHitLoggerMiddleware',
     'drf_signal_simplejwt.middleware.CaptureIPMiddleware',
@@ -163,7 +164,8 @@ AUTH_PASSWORD_VALIDATORS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'drf_signal_simplejwt.authentication.SharedJWTAuthentication',    # ? JWTAuthentication reusing the token verified by JWTClaimsMiddleware.
+        # 'rest_framework_simplejwt.authentication.JWTAuthentication',
         # 'rest_framework.authentication.TokenAuthentication',
         # 'knox.auth.TokenAuthentication',
     ),
@@ -318,6 +320,13 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 
 NEW_USER_DEFAULT_PASSWORD = str(os.getenv('NEW_USER_DEFAULT_PASSWORD', '123456'))
+SUBSCRIPTION_ENTITLEMENT_CACHE_MAX_SECS = int(os.getenv('SUBSCRIPTION_ENTITLEMENT_CACHE_MAX_SECS', '300'))    # ? Upper bound of the cached subscription verdicts of SubscriptionMiddleware, see master/entitlements.py.
+# ? APIHitLoggerMiddleware buffers the hits in memory, written in bulk by a background thread, see drf_signal_simplejwt/api_hit_log_buffer.py.
+API_HIT_LOG_BUFFER_SIZE = int(os.getenv('API_HIT_LOG_BUFFER_SIZE', '10000'))    # Max. hits waiting to be written, the oldest ones are dropped beyond.
+API_HIT_LOG_FLUSH_SIZE = int(os.getenv('API_HIT_LOG_FLUSH_SIZE', '500'))    # Max. rows per bulk_create.
+API_HIT_LOG_FLUSH_INTERVAL_MS = int(os.getenv('API_HIT_LOG_FLUSH_INTERVAL_MS', '1000'))    # A partial batch is written after this.
+INTERNAL_IP_REFRESH_SECS = int(os.getenv('INTERNAL_IP_REFRESH_SECS', '300'))    # ? The internal IP logged by the middlewares is resolved once, then refreshed this often. 0: never.
+USER_CODE_BLOCK_SIZE = int(os.getenv('USER_CODE_BLOCK_SIZE', '100'))    # ? `user_code`s reserved per process at once, see UserCodeAllocator in users/models.py.
 
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME' : timedelta(minutes=525600),    # ? Access Token life time, Default: 5 mins. [KEEP THIS VALUE LOW FOR SECURITY REASONS]. Ideally, it should be 120 minutes.
@@ -354,8 +363,22 @@ RABBITMQ = {
 
     'USER_SYNC_EXCHANGE_NAME': os.environ.get('USER_SYNC_EXCHANGE_NAME', 'drf_exchange'),
     'USER_SYNC_QUEUE_NAME': os.environ.get('USER_SYNC_QUEUE_NAME', 'drf_queue'),
+    # ? Spreads the user sync messages over this many `<queue>.p<k>` / `<exchange>.p<k>` partitions, by a stable hash of the user id. 0 keeps the single queue.
+    # ! Changing it remaps users to other partitions, drain the queues first or the messages of a user may be applied out of order.
+    'USER_SYNC_PARTITIONS': int(os.environ.get('USER_SYNC_PARTITIONS', '0')),
+    # ? 'full': every user sync message carries the whole user row. 'diff': updates only carry the changed fields (+ `username` / `lookup_username`), applied as a partial update by the consumer.
+    'USER_SYNC_PAYLOAD_MODE': os.environ.get('USER_SYNC_PAYLOAD_MODE', 'full'),
+
+    # ? UDP address of producer_service.py, nudged on commit of every new `QueuePublishHistory` row so the relay publishes it right away. Port 0 disables it.
+    'OUTBOX_WAKEUP_HOST': os.environ.get('OUTBOX_WAKEUP_HOST', '127.0.0.1'),
+    'OUTBOX_WAKEUP_PORT': int(os.environ.get('OUTBOX_WAKEUP_PORT', '50515')),
 }
 
+# ? `published` rows of `queue_publish_history` older than this are moved to `queue_publish_history_archive` daily, see pubsub/tasks.py.
+QUEUE_PUBLISH_HISTORY_RETENTION_DAYS = int(os.environ.get('QUEUE_PUBLISH_HISTORY_RETENTION_DAYS', '30'))
+# ? `processed_message` rows older than this are deleted daily, see pubsub/tasks.py. Keep it longer than a message can still be redelivered or republished (TTL, retries, admin requeue).
+PROCESSED_MESSAGE_RETENTION_DAYS = int(os.environ.get('PROCESSED_MESSAGE_RETENTION_DAYS', '30'))
+
 
 CELERY_BROKER_URL = 'redis://192.168.0.111:6379/0'
 CELERY_RESULT_BACKEND = 'redis://192.168.0.111:6379/0'
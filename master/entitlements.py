@@ -0,0 +1,70 @@
+'''
+Purpose: Subscription entitlement of the users, checked by SubscriptionMiddleware on every request. Cached, so the steady state costs no query:
+    - `subscription_entitlement:user:<user_id>`: {'is_superuser', 'college_id'} of the user, invalidated on save / delete of the user.
+    - `subscription_entitlement:college:<college_id>`: verdict of the college's plan, invalidated on save / delete of its CollegePlanMapping.
+A verdict only flips by itself at the midnight after `plan_valid_until` / `trial_end_date`, so it is never cached past the next such boundary.
+NB: The invalidations (master/signals.py) only reach the other processes through a shared cache backend (settings.CACHES). With the per process
+default (LocMemCache) the other processes catch up within SUBSCRIPTION_ENTITLEMENT_CACHE_MAX_SECS. `.update()` querysets don't send signals either.
+'''
+
+from datetime import date, datetime, time, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+
+from master.models import CollegePlanMapping
+from users.models import UserDetail
+
+
+USER_ENTITLEMENT_CACHE_KEY: str = 'subscription_entitlement:user:{}'
+COLLEGE_ENTITLEMENT_CACHE_KEY: str = 'subscription_entitlement:college:{}'
+
+
+def get_plan_verdict(college_plan_mapping_obj: CollegePlanMapping) -> tuple:
+    '''
+    Returns (is_plan_active, valid_for_secs). `valid_for_secs` is the time left until the verdict flips by itself, None if it never does without a change of the row.
+    Same rules (and same `date.today()` day boundaries) as the original inline check of SubscriptionMiddleware.
+    '''
+    today = date.today()
+    if not college_plan_mapping_obj.is_active or college_plan_mapping_obj.is_cancelled:
+        return False, None
+
+    last_valid_dates: list = []
+    if college_plan_mapping_obj.plan_valid_until:
+        last_valid_dates.append(college_plan_mapping_obj.plan_valid_until.date())
+    if college_plan_mapping_obj.is_trial and college_plan_mapping_obj.trial_end_date:
+        last_valid_dates.append(college_plan_mapping_obj.trial_end_date.date())
+    if not last_valid_dates:
+        return True, None    # ? Valid forever.
+    if min(last_valid_dates) < today:
+        return False, None
+
+    expires_at = datetime.combine(min(last_valid_dates) + timedelta(days=1), time.min)
+    return True, (expires_at - datetime.now()).total_seconds()
+
+
+def get_user_entitlement(user_id: int) -> dict:
+    cache_key: str = USER_ENTITLEMENT_CACHE_KEY.format(user_id)
+    user_entitlement = cache.get(cache_key)
+    if user_entitlement is None:
+        user_entitlement = UserDetail.objects.values('is_superuser', 'college_id').get(id=user_id)
+        cache.set(cache_key, user_entitlement, timeout=settings.SUBSCRIPTION_ENTITLEMENT_CACHE_MAX_SECS)
+    return user_entitlement
+
+
+def is_college_plan_active(college_id: int) -> bool:
+    cache_key: str = COLLEGE_ENTITLEMENT_CACHE_KEY.format(college_id)
+    is_plan_active = cache.get(cache_key)
+    if is_plan_active is None:
+        is_plan_active, valid_for_secs = get_plan_verdict(CollegePlanMapping.objects.get(college_id=college_id))
+        timeout: float = settings.SUBSCRIPTION_ENTITLEMENT_CACHE_MAX_SECS if valid_for_secs is None else min(settings.SUBSCRIPTION_ENTITLEMENT_CACHE_MAX_SECS, valid_for_secs)
+        cache.set(cache_key, is_plan_active, timeout=max(int(timeout), 1))
+    return is_plan_active
+
+
+def invalidate_user_entitlement(user_id: int) -> None:
+    cache.delete(USER_ENTITLEMENT_CACHE_KEY.format(user_id))
+
+
+def invalidate_college_entitlement(college_id: int) -> None:
+    cache.delete(COLLEGE_ENTITLEMENT_CACHE_KEY.format(college_id))
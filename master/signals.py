@@ -0,0 +1,23 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from master.models import CollegePlanMapping
+from master.entitlements import invalidate_user_entitlement, invalidate_college_entitlement
+from users.models import UserDetail
+
+
+USER_ENTITLEMENT_FIELDS: set = {'is_superuser', 'college', 'college_id'}    # ? Only these are cached per user, see master/entitlements.py.
+
+
+@receiver([post_save, post_delete], sender=CollegePlanMapping)
+def invalidate_college_entitlement_on_change(sender, instance, **kwargs):
+    # ? On commit, so a concurrent request can't cache the old row again in between.
+    transaction.on_commit(lambda: invalidate_college_entitlement(instance.college_id))
+
+
+@receiver([post_save, post_delete], sender=UserDetail)
+def invalidate_user_entitlement_on_change(sender, instance, update_fields=None, **kwargs):
+    if update_fields and not USER_ENTITLEMENT_FIELDS.intersection(update_fields):
+        return    # * e.g. the `last_login` update of every login.
+    transaction.on_commit(lambda: invalidate_user_entitlement(instance.pk))
@@ -1,13 +1,20 @@
 import os
-import json
+import sys
 import time
+import socket
+import argparse
+import threading
 
 import pika
 from pika.exchange_type import ExchangeType
 import pymysql
+from prometheus_client import Counter, Histogram, start_http_server
 from django.conf import settings
 from AshLogger import AshLogger
 
+from pubsub.codecs import WIRE_FORMATS, encode_message_body
+from pubsub.retry import build_retry_assignments
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'drf_signal_simplejwt.settings')
 
 logger_obj = AshLogger(file_name='producer_service.log', file_location=os.path.join(settings.BASE_DIR, 'logs'), max_bytes=10000000, max_backups=1)
@@ -34,9 +41,44 @@ RABBITMQ_PASSWORD = settings.RABBITMQ['PASSWORD']
 # Sleep interval in seconds for retrying connection to MySQL, RabbitMQ & Queue Publishing DB fetching interval.
 SLEEP_INTERVAL: int = 10
 
-QUEUE_HISTORY_TABLE_NAME: str = 'queue_publish_history'
-STATUS_TO_PUBLISH: tuple = ('pending', 'error', 'expired')
+# ? The relay is woken up by a UDP nudge sent by `pubsub.utils.queue_msg_to_publish` on transaction commit. Polling is only the fallback,
+# ? its interval starts at MIN and doubles on every idle cycle up to MAX, and is reset as soon as there is something to publish.
+OUTBOX_WAKEUP_HOST: str = settings.RABBITMQ['OUTBOX_WAKEUP_HOST']
+OUTBOX_WAKEUP_PORT: int = settings.RABBITMQ['OUTBOX_WAKEUP_PORT']    # 0 disables the nudges, then the relay only polls.
+OUTBOX_MIN_POLL_INTERVAL: float = float(os.environ.get('OUTBOX_MIN_POLL_INTERVAL', 1))
+OUTBOX_MAX_POLL_INTERVAL: float = float(os.environ.get('OUTBOX_MAX_POLL_INTERVAL', 60))
+
+# ? 'confirm': Publisher confirms, a window of messages is published and the broker acks are awaited in bulk. 'tx': Legacy AMQP transaction per message (slowest delivery guarantee).
+PUBLISH_MODE: str = os.environ.get('OUTBOX_PUBLISH_MODE', 'confirm')
+PUBLISH_CONFIRM_WINDOW: int = int(os.environ.get('OUTBOX_PUBLISH_CONFIRM_WINDOW', 500))    # Max. number of messages in flight before waiting for the broker acks.
+PUBLISH_CONFIRM_TIMEOUT_SECS: int = int(os.environ.get('OUTBOX_PUBLISH_CONFIRM_TIMEOUT_SECS', 30))    # Unconfirmed messages of a window are marked as error after this timeout.
 
+OUTBOX_WIRE_FORMAT: str = os.environ.get('OUTBOX_WIRE_FORMAT', 'json')    # ? One of pubsub.codecs.WIRE_FORMATS. 'msgpack' is opt-in, consumers pick the decoder from the content_type.
+assert OUTBOX_WIRE_FORMAT in WIRE_FORMATS, f'OUTBOX_WIRE_FORMAT should be one of {WIRE_FORMATS}.'
+
+QUEUE_HISTORY_TABLE_NAME: str = 'queue_publish_history'
+STATUS_TO_PUBLISH: tuple = ('pending', 'error', 'expired')    # ? Only once due (`next_attempt_at`). `failed` rows, out of attempts, are never republished.
+OUTBOX_FETCH_BATCH_SIZE: int = int(os.environ.get('OUTBOX_FETCH_BATCH_SIZE', 1000))    # Max. rows held in memory at once, the backlog is walked in id order batches of this size.
+RELAY_WORKERS: int = int(os.environ.get('OUTBOX_RELAY_WORKERS', 1))    # Relay worker threads in this process. More processes / hosts can be started as well, rows are split between them by claiming.
+OUTBOX_LEASE_SECS: int = int(os.environ.get('OUTBOX_LEASE_SECS', 300))    # ? A claimed row is owned by a worker until then. If the worker dies, the row is reclaimed by another one after the lease expires.
+RELAY_METRICS_PORT: int = int(os.environ.get('OUTBOX_RELAY_METRICS_PORT', 0))    # ? Prometheus metrics are served on this port when non zero.
+OUTBOX_COLUMNS: tuple = (    # ? Only the columns needed to publish a message are fetched.
+                    'id'
+                    , 'queue_name'
+                    , 'exchange_name'
+                    , 'deadletter_queue_name'
+                    , 'deadletter_exchange_name'
+                    , 'message_body_json'
+                    , 'delivery_mode'
+                    , 'expiration_secs'
+                    , 'message_id'
+                )
+
+
+
+# * Relay metrics, scraped from `http://<host>:<OUTBOX_RELAY_METRICS_PORT>/metrics`.
+OUTBOX_STATUS_TRANSITIONS = Counter('outbox_status_transitions_total', 'Outbox rows moved to a new status by the relay.', ['status'])
+OUTBOX_STATUS_FLUSH_SIZE = Histogram('outbox_status_flush_size', 'Status transitions written per flush.', buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000))
 
 
 def connect_to_mysql():
@@ -73,20 +115,22 @@ def connect_to_mysql():
             time.sleep(SLEEP_INTERVAL)
 
 
+def get_rabbitmq_connection_parameters() -> pika.ConnectionParameters:
+    return pika.ConnectionParameters(
+                host = RABBITMQ_HOST
+                , port = RABBITMQ_PORT
+                , virtual_host = RABBITMQ_VHOST
+                , credentials = pika.PlainCredentials(
+                                    username = RABBITMQ_USERNAME
+                                    , password = RABBITMQ_PASSWORD
+                )
+            )
+
+
 def connect_to_rabbitmq():
     while True:    # * Infinite loop, will automatically reconnect to RabbitMQ if connection is lost. As in main() funciton this function is being called over and over again in a while True infinite loop.
         try:
-            connection = pika.BlockingConnection(
-                            pika.ConnectionParameters(
-                                host = RABBITMQ_HOST
-                                , port = RABBITMQ_PORT
-                                , virtual_host = RABBITMQ_VHOST
-                                , credentials = pika.PlainCredentials(
-                                                    username = RABBITMQ_USERNAME
-                                                    , password = RABBITMQ_PASSWORD
-                                )
-                            )
-                        )
+            connection = pika.BlockingConnection(get_rabbitmq_connection_parameters())
 
             channel = connection.channel()
             # print("### CONNECTED TO RABBITMQ SERVER '{}' HAVING PORT '{}' WITH USERNAME '{}' ON VHOST '{}' ###".format(
@@ -112,8 +156,61 @@ def connect_to_rabbitmq():
             time.sleep(SLEEP_INTERVAL)
 
 
-def publish_msg_to_rabbitmq(
-                queue_name: str
+class RabbitMQPublisher:
+    '''
+    Long lived publisher session. One connection & channel is kept open per worker and reused for every outbox row.
+    Topology (queue, exchange, DLQ, DLX) already declared on the current channel is cached, so it is declared only once per channel instead of once per message.
+    If the connection or channel is lost, it is transparently re-opened (and the topology cache is reset) before the next publish.
+    '''
+
+    def __init__(self):
+        self.connection = None
+        self.channel = None
+        self.declared_topologies: set = set()
+
+    def is_open(self) -> bool:
+        return bool(self.connection and self.connection.is_open and self.channel and self.channel.is_open)
+
+    def connect(self) -> None:
+        self.close()
+        self.connection, self.channel = connect_to_rabbitmq()
+        self.channel.tx_select()    # * Enables Transactions, once per channel.
+        self.declared_topologies = set()    # ? Declarations belong to the channel, so a fresh channel starts with an empty cache.
+
+    def close(self) -> None:
+        for resource in (self.channel, self.connection):
+            try:
+                if resource and resource.is_open:
+                    resource.close()
+            except Exception:
+                pass
+        self.connection, self.channel = None, None
+
+    def declare_topology(self, queue_name: str, exchange_name: str, deadletter_queue_name: str, deadletter_exchange_name: str) -> None:
+        topology_key: tuple = (queue_name, exchange_name, deadletter_queue_name, deadletter_exchange_name)
+        if topology_key in self.declared_topologies:
+            return
+
+        # * Declare a dead-letter queue name and exchange name & type (create if it doesn't exist).
+        self.channel.queue_declare(queue=deadletter_queue_name, durable=True)    # ? durable=True: The queue will survive server restarts. Durable queues do not necessarily hold persistent messages, although it does not make sense to send persistent messages to a transient queue.
+        self.channel.exchange_declare(exchange=deadletter_exchange_name, exchange_type=ExchangeType.direct)
+        self.channel.queue_bind(exchange=deadletter_exchange_name, queue=deadletter_queue_name, routing_key='')    # ? Bind the queue to the exchange with an empty routing key.
+
+        # * Declare a queue name and exchange name & type (create if it doesn't exist).
+        self.channel.queue_declare(queue=queue_name, durable=True    # ? durable=True: The queue will survive server restarts. Durable queues do not necessarily hold persistent messages, although it does not make sense to send persistent messages to a transient queue.
+                                    , arguments={
+                                        "x-dead-letter-exchange": deadletter_exchange_name  # Use DLX exchange
+                                        # , "x-dead-letter-routing-key": deadletter_queue_name  # Routing key for DLQ
+                                    }
+                    )
+        self.channel.exchange_declare(exchange=exchange_name, exchange_type=ExchangeType.direct)
+        self.channel.queue_bind(exchange=exchange_name, queue=queue_name, routing_key='')    # ? Bind the queue to the exchange with an empty routing key.
+
+        self.declared_topologies.add(topology_key)
+
+    def publish(
+                self
+                , queue_name: str
                 , exchange_name: str
                 , deadletter_queue_name: str
                 , deadletter_exchange_name: str
@@ -121,131 +218,561 @@ def publish_msg_to_rabbitmq(
                 , delivery_mode: int
                 , expiration_secs: int
                 , message_id: str
-) -> bool:
-
-    # Connect to RabbitMQ
-    rabbitmq_connection, rabbitmq_channel = connect_to_rabbitmq()
-
-    # # * Enables Publish Confirms
-    # channel.confirm_delivery()
-
-    try:
-
-        # * Enables Transactions
-        rabbitmq_channel.tx_select()
-
-        # * Declare a dead-letter queue name and exchange name & type (create if it doesn't exist).
-        rabbitmq_channel.queue_declare(queue=deadletter_queue_name, durable=True)    # ? durable=True: The queue will survive server restarts. Durable queues do not necessarily hold persistent messages, although it does not make sense to send persistent messages to a transient queue.
-        rabbitmq_channel.exchange_declare(exchange=deadletter_exchange_name, exchange_type=ExchangeType.direct)
-        rabbitmq_channel.queue_bind(exchange=deadletter_exchange_name, queue=deadletter_queue_name, routing_key='')    # ? Bind the queue to the exchange with an empty routing key.
-
-        # * Declare a queue name and exchange name & type (create if it doesn't exist).
-        rabbitmq_channel.queue_declare(queue=queue_name, durable=True    # ? durable=True: The queue will survive server restarts. Durable queues do not necessarily hold persistent messages, although it does not make sense to send persistent messages to a transient queue.
-                                        , arguments={
-                                            "x-dead-letter-exchange": deadletter_exchange_name  # Use DLX exchange
-                                            # , "x-dead-letter-routing-key": deadletter_queue_name  # Routing key for DLQ
-                                        }
-                        )
-        rabbitmq_channel.exchange_declare(exchange=exchange_name, exchange_type=ExchangeType.direct)
-        rabbitmq_channel.queue_bind(exchange=exchange_name, queue=queue_name, routing_key='')    # ? Bind the queue to the exchange with an empty routing key.
+    ) -> None:
+        if not self.is_open():
+            self.connect()
 
+        self.declare_topology(queue_name, exchange_name, deadletter_queue_name, deadletter_exchange_name)
 
         # * Publishing a message to the queue declared above.
-        rabbitmq_channel.basic_publish(
+        body, content_type = encode_message_body(message_body, OUTBOX_WIRE_FORMAT)
+        self.channel.basic_publish(
                             exchange=exchange_name,
                             routing_key='',    # Empty routing key to send to the bound queue directly.
-                            body=json.dumps(message_body),
+                            body=body,
                             properties=pika.BasicProperties(
-                                            content_type='application/json'
+                                            content_type=content_type
                                             , delivery_mode=delivery_mode
                                             , message_id=message_id    # or use, correlation_id
                                             , expiration=str(expiration_secs * 1000)    # ? 7 days in milliseconds if = 604800000.
                         )
         )
 
-        # print(f' [PUBLISHED MSG] -----> {json.dumps(message_body)}')
-        ash_logger.info(f' [PUBLISHED MSG] -----> {json.dumps(message_body)}')
+        # * Commit the transaction
+        self.channel.tx_commit()
 
-        # if rabbitmq_channel.waitForConfirms():
-        #     print(f' [x] Sent Msg: {json.dumps(message_body)}')
-        # else: print("Message NOT delivered successfully !!!")
 
+# ? One publisher session per relay worker (thread), shared by every publish of that worker. pika connections must not be shared across threads.
+relay_worker_state = threading.local()
 
-        # * Commit the transaction
-        rabbitmq_channel.tx_commit()
+
+def get_rabbitmq_publisher() -> RabbitMQPublisher:
+    if not hasattr(relay_worker_state, 'rabbitmq_publisher'):
+        relay_worker_state.rabbitmq_publisher = RabbitMQPublisher()
+    return relay_worker_state.rabbitmq_publisher
 
 
+def publish_msg_to_rabbitmq(
+                queue_name: str
+                , exchange_name: str
+                , deadletter_queue_name: str
+                , deadletter_exchange_name: str
+                , message_body: dict
+                , delivery_mode: int
+                , expiration_secs: int
+                , message_id: str
+) -> bool:
+
+    publish_kwargs: dict = dict(
+                        queue_name = queue_name
+                        , exchange_name = exchange_name
+                        , deadletter_queue_name = deadletter_queue_name
+                        , deadletter_exchange_name = deadletter_exchange_name
+                        , message_body = message_body
+                        , delivery_mode = delivery_mode
+                        , expiration_secs = expiration_secs
+                        , message_id = message_id
+    )
+
+    rabbitmq_publisher = get_rabbitmq_publisher()
+    try:
+        try:
+            rabbitmq_publisher.publish(**publish_kwargs)
+        except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError, pika.exceptions.StreamLostError):
+            # ? Stale session (broker restarted, idle connection dropped, channel closed by a failed declare). Reconnect once and retry.
+            ash_logger.info('Publisher session lost. Reconnecting to RabbitMQ and retrying the publish once ...')
+            rabbitmq_publisher.connect()
+            rabbitmq_publisher.publish(**publish_kwargs)
+
+        # print(f' [PUBLISHED MSG] -----> {message_body}')
+        ash_logger.info(f' [PUBLISHED MSG] -----> {message_body}')
+
     except Exception as e:
         # Handle exceptions or roll back the transaction on error
-        rabbitmq_channel.tx_rollback()
+        try:
+            if rabbitmq_publisher.is_open():
+                rabbitmq_publisher.channel.tx_rollback()
+        except Exception:
+            rabbitmq_publisher.close()    # ? Session is unusable, a fresh one will be opened on the next publish.
         # print(f"Error -----> {str(e)}")
         ash_logger.info(f"Error -----> {str(e)}")
         return False, str(e)
 
     else: return True, None
 
-    finally:    # This `finally` block will always run, even if there is return statement in the try, except or else block.
-        # * Close the rabbitmq channel.
-        rabbitmq_channel.close()
 
-        # * Close the rabbitmq connection.
-        rabbitmq_connection.close()
+class ConfirmRabbitMQPublisher:
+    '''
+    Publisher confirms based session. Messages are published without waiting, each one gets a broker side delivery tag, and
+    wait_for_confirms() collects the Basic.Ack / Basic.Nack frames (which may cover several tags at once with `multiple=True`) for the whole window.
+    Built on pika's SelectConnection because BlockingChannel waits for the confirm of every single basic_publish. The ioloop is driven manually
+    (poll + process_timeouts, same as BlockingConnection does internally) so the relay stays a simple synchronous loop.
+    '''
+
+    def __init__(self, confirm_timeout_secs: int = PUBLISH_CONFIRM_TIMEOUT_SECS):
+        self.confirm_timeout_secs = confirm_timeout_secs
+        self.connection = None
+        self.channel = None
+        self.declared_topologies: set = set()
+        self.delivery_tag: int = 0
+        self.unconfirmed: dict = {}    # delivery_tag -> outbox row id
+        self.acked_ids: list = []
+        self.nacked_ids: list = []
+        self.close_reason = None
+
+    def is_open(self) -> bool:
+        return bool(self.connection and self.connection.is_open and self.channel and self.channel.is_open)
+
+    def _on_connection_closed(self, connection, reason) -> None:
+        self.close_reason = reason
+
+    def _on_channel_closed(self, channel, reason) -> None:
+        self.close_reason = reason
+
+    def _process_io_until(self, predicate, timeout_secs: int) -> None:
+        deadline = time.monotonic() + timeout_secs
+        while not predicate():
+            if self.close_reason is not None:
+                raise pika.exceptions.AMQPConnectionError(str(self.close_reason))
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'No response from RabbitMQ within {timeout_secs} seconds.')
+            self.connection.ioloop.poll()
+            self.connection.ioloop.process_timeouts()
+
+    def connect(self) -> None:
+        self.close()
+        self.close_reason = None
+        state: dict = {}
+
+        self.connection = pika.SelectConnection(
+                                parameters=get_rabbitmq_connection_parameters()
+                                , on_open_callback=lambda connection: state.update(connection_opened=True)
+                                , on_open_error_callback=self._on_connection_closed
+                                , on_close_callback=self._on_connection_closed
+                            )
+        self._process_io_until(lambda: state.get('connection_opened'), self.confirm_timeout_secs)
+
+        self.connection.channel(on_open_callback=lambda channel: state.update(channel=channel))
+        self._process_io_until(lambda: state.get('channel'), self.confirm_timeout_secs)
+        self.channel = state['channel']
+        self.channel.add_on_close_callback(self._on_channel_closed)
+
+        # * Enables Publish Confirms, once per channel.
+        self.channel.confirm_delivery(ack_nack_callback=self._on_delivery_confirmation, callback=lambda frame: state.update(confirm_selected=True))
+        self._process_io_until(lambda: state.get('confirm_selected'), self.confirm_timeout_secs)
+
+        self.declared_topologies = set()
+        self.delivery_tag = 0    # ? Delivery tags restart from 1 on every new channel.
+        self.unconfirmed = {}
+
+    def ensure_open(self) -> None:
+        '''
+        The ioloop only runs while publishing, so no heartbeats go out while the relay is idle and the broker may have dropped the connection
+        meanwhile, without is_open() noticing. Processes the pending I/O (close frames, EOF, missed heartbeats) without blocking, and reconnects
+        if the session is gone. Called before every window, so a dead session doesn't fail (and use up an attempt of) every row of it.
+        '''
+        if self.is_open() and self.close_reason is None:
+            try:
+                self.connection.ioloop.call_later(0, lambda: None)    # ? Due timer, so poll() returns at once instead of blocking until the next one.
+                self.connection.ioloop.poll()
+                self.connection.ioloop.process_timeouts()
+            except Exception as e:
+                self.close_reason = self.close_reason or e
+        if not self.is_open() or self.close_reason is not None:
+            ash_logger.info(f'Publisher session lost while idle ({self.close_reason}). Reconnecting to RabbitMQ ...')
+            self.connect()
+
+    def close(self) -> None:
+        if self.connection is not None:
+            try:
+                if self.connection.is_open:
+                    self.connection.close()
+                self.close_reason = None    # ? A channel error already recorded would abort the wait below and leak the socket.
+                self._process_io_until(lambda: self.connection.is_closed, self.confirm_timeout_secs)
+            except Exception:
+                pass
+            finally:
+                self.connection.ioloop.close()    # ? Frees the poller of this connection, a new one is created on connect().
+        self.connection, self.channel = None, None
+
+    def declare_topology(self, queue_name: str, exchange_name: str, deadletter_queue_name: str, deadletter_exchange_name: str) -> None:
+        topology_key: tuple = (queue_name, exchange_name, deadletter_queue_name, deadletter_exchange_name)
+        if topology_key in self.declared_topologies:
+            return
+
+        # ? pika serializes the channel RPCs, so all the declarations are sent at once and we wait for all of their replies.
+        replies: list = []
+        on_reply = lambda frame: replies.append(frame)
+        self.channel.queue_declare(queue=deadletter_queue_name, durable=True, callback=on_reply)
+        self.channel.exchange_declare(exchange=deadletter_exchange_name, exchange_type=ExchangeType.direct, callback=on_reply)
+        self.channel.queue_bind(exchange=deadletter_exchange_name, queue=deadletter_queue_name, routing_key='', callback=on_reply)
+        self.channel.queue_declare(queue=queue_name, durable=True
+                                    , arguments={
+                                        "x-dead-letter-exchange": deadletter_exchange_name  # Use DLX exchange
+                                    }
+                                    , callback=on_reply
+                    )
+        self.channel.exchange_declare(exchange=exchange_name, exchange_type=ExchangeType.direct, callback=on_reply)
+        self.channel.queue_bind(exchange=exchange_name, queue=queue_name, routing_key='', callback=on_reply)
+        self._process_io_until(lambda: len(replies) == 6, self.confirm_timeout_secs)
+
+        self.declared_topologies.add(topology_key)
+
+    def publish(self, record_id: int, queue_name: str, exchange_name: str, deadletter_queue_name: str, deadletter_exchange_name: str
+                , message_body: dict, delivery_mode: int, expiration_secs: int, message_id: str) -> None:
+        if not self.is_open():
+            self.connect()
+
+        self.declare_topology(queue_name, exchange_name, deadletter_queue_name, deadletter_exchange_name)
+
+        body, content_type = encode_message_body(message_body, OUTBOX_WIRE_FORMAT)
+        self.channel.basic_publish(
+                            exchange=exchange_name,
+                            routing_key='',    # Empty routing key to send to the bound queue directly.
+                            body=body,
+                            properties=pika.BasicProperties(
+                                            content_type=content_type
+                                            , delivery_mode=delivery_mode
+                                            , message_id=message_id    # or use, correlation_id
+                                            , expiration=str(expiration_secs * 1000)    # ? 7 days in milliseconds if = 604800000.
+                        )
+        )
+        self.delivery_tag += 1
+        self.unconfirmed[self.delivery_tag] = record_id
+
+    def _on_delivery_confirmation(self, method_frame) -> None:
+        method = method_frame.method
+        if method.multiple:    # ? One ack/nack frame confirms every outstanding delivery tag up to and including this one.
+            delivery_tags = [delivery_tag for delivery_tag in self.unconfirmed if delivery_tag <= method.delivery_tag]
+        else:
+            delivery_tags = [method.delivery_tag]
+
+        confirmed_ids = self.acked_ids if isinstance(method, pika.spec.Basic.Ack) else self.nacked_ids
+        for delivery_tag in delivery_tags:
+            record_id = self.unconfirmed.pop(delivery_tag, None)
+            if record_id is not None:
+                confirmed_ids.append(record_id)
+
+    def wait_for_confirms(self) -> tuple:
+        '''
+        Waits until every message published since the last call is acked or nacked by the broker.
+        Returns (acked_ids, nacked_ids, unconfirmed_ids, error_msg). Unconfirmed ids are the ones lost with the connection or timed out, their delivery is unknown.
+        '''
+        error_msg = None
+        try:
+            if self.unconfirmed:
+                self._process_io_until(lambda: not self.unconfirmed, self.confirm_timeout_secs)
+        except Exception as e:
+            error_msg = str(e)
+            self.close()    # ? Tags of this channel can no longer be confirmed, a fresh session is opened for the next window.
 
+        acked_ids, nacked_ids, unconfirmed_ids = self.acked_ids, self.nacked_ids, list(self.unconfirmed.values())
+        self.acked_ids, self.nacked_ids, self.unconfirmed = [], [], {}
+        return acked_ids, nacked_ids, unconfirmed_ids, error_msg
 
-def main():
+
+def get_confirm_rabbitmq_publisher() -> ConfirmRabbitMQPublisher:
+    if not hasattr(relay_worker_state, 'confirm_rabbitmq_publisher'):
+        relay_worker_state.confirm_rabbitmq_publisher = ConfirmRabbitMQPublisher()
+    return relay_worker_state.confirm_rabbitmq_publisher
+
+
+def publish_window_with_confirms(records: list) -> dict:
+    '''
+    Publishes a window of outbox rows in confirm mode and waits for the broker acks in bulk.
+    Returns {row id: (status, error_msg)}. Only acked rows are 'published', nacked / unconfirmed / failed rows are 'error', rows not attempted after the session was lost are None (lease released only).
+    '''
+    confirm_rabbitmq_publisher = get_confirm_rabbitmq_publisher()
+    publish_results: dict = {}
+    try:
+        confirm_rabbitmq_publisher.ensure_open()
+    except Exception as e:
+        ash_logger.info(f"Could not connect to RabbitMQ -----> {str(e)}")    # ? publish() retries the connection for the first row.
+    for record_index, record in enumerate(records):
+        try:
+            confirm_rabbitmq_publisher.publish(
+                                        record_id = record["id"]
+                                        , queue_name = record["queue_name"]
+                                        , exchange_name = record["exchange_name"]
+                                        , deadletter_queue_name = record["deadletter_queue_name"]
+                                        , deadletter_exchange_name = record["deadletter_exchange_name"]
+                                        , message_body = record["message_body_json"]
+                                        , delivery_mode = record["delivery_mode"]
+                                        , expiration_secs = record["expiration_secs"]
+                                        , message_id = record["message_id"]
+                        )
+        except Exception as e:
+            ash_logger.info(f"Error while publishing id: {record['id']} -----> {str(e)}")
+            publish_results[record["id"]] = ('error', str(e))
+            if not confirm_rabbitmq_publisher.is_open():
+                # ? Session is gone. The rest of the window is not attempted, its lease is released on flush (status None) so that
+                # ? the next cycle picks it up, instead of waiting OUTBOX_LEASE_SECS for the lease to expire.
+                for untouched_record in records[record_index + 1:]:
+                    publish_results[untouched_record["id"]] = (None, None)
+                break
+
+    acked_ids, nacked_ids, unconfirmed_ids, error_msg = confirm_rabbitmq_publisher.wait_for_confirms()
+    for record_id in acked_ids:
+        publish_results[record_id] = ('published', None)
+    for record_id in nacked_ids:
+        publish_results[record_id] = ('error', 'Message nacked by RabbitMQ.')
+    for record_id in unconfirmed_ids:
+        publish_results[record_id] = ('error', error_msg or 'Message not confirmed by RabbitMQ.')
+
+    ash_logger.info(f'Confirm window done ---> acked: {len(acked_ids)}, nacked: {len(nacked_ids)}, unconfirmed: {len(unconfirmed_ids)}')
+    return publish_results
+
+
+def publish_window_with_transactions(records: list) -> dict:
+    publish_results: dict = {}
+    for record in records:
+        status_bool, error_msg = publish_msg_to_rabbitmq(
+                                    queue_name = record["queue_name"]
+                                    , exchange_name = record["exchange_name"]
+                                    , deadletter_queue_name = record["deadletter_queue_name"]
+                                    , deadletter_exchange_name = record["deadletter_exchange_name"]
+                                    , message_body = record["message_body_json"]
+                                    , delivery_mode = record["delivery_mode"]
+                                    , expiration_secs = record["expiration_secs"]
+                                    , message_id = record["message_id"]
+                    )
+        publish_results[record["id"]] = ('error', error_msg) if error_msg else ('published', None)
+    return publish_results
+
+
+def publish_window(records: list) -> dict:
+    if PUBLISH_MODE == 'tx':
+        return publish_window_with_transactions(records)
+    return publish_window_with_confirms(records)
+
+
+def build_claim_queries(worker_id: str, after_id: int, batch_size: int) -> tuple:
+    '''
+    Returns ((select_sql, select_params), lease_query_builder) of the claim protocol, shared by the sync and the async engine.
+    `lease_query_builder(record_ids)` returns the (sql, params) stamping the lease on the selected rows.
+    '''
+    select_sql_query = f"SELECT {', '.join(OUTBOX_COLUMNS)} FROM {MYSQL_DB}.{QUEUE_HISTORY_TABLE_NAME}"
+    select_sql_query += f" WHERE status IN ({', '.join(['%s'] * len(STATUS_TO_PUBLISH))}) AND id > %s"
+    select_sql_query += " AND (lease_expires_at IS NULL OR lease_expires_at < UTC_TIMESTAMP())"
+    select_sql_query += " AND (next_attempt_at IS NULL OR next_attempt_at <= UTC_TIMESTAMP())"    # ? Only the rows due for a retry, see pubsub/retry.py.
+    select_sql_query += " ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED"
+
+    def lease_query_builder(record_ids: list) -> tuple:
+        lease_sql_query = f"UPDATE {MYSQL_DB}.{QUEUE_HISTORY_TABLE_NAME} SET lease_owner = %s, lease_expires_at = UTC_TIMESTAMP() + INTERVAL %s SECOND"
+        lease_sql_query += f" WHERE id IN ({', '.join(['%s'] * len(record_ids))})"
+        return lease_sql_query, (worker_id, OUTBOX_LEASE_SECS, *record_ids)
+
+    return (select_sql_query, (*STATUS_TO_PUBLISH, after_id, batch_size)), lease_query_builder
+
+
+def claim_outbox_batch(mysql_connection, mysql_cursor, worker_id: str, after_id: int, batch_size: int = OUTBOX_FETCH_BATCH_SIZE) -> list:
+    '''
+    Claims and returns the next `batch_size` publishable rows having id greater than `after_id`, in id order (keyset pagination).
+    `SELECT ... FOR UPDATE SKIP LOCKED` (MySQL 8+) skips the rows being claimed by other workers at the same moment, and the lease columns
+    written in the same transaction keep them owned by this worker until they are flushed or the lease expires (worker died).
+    So any number of relay threads / processes / hosts can split the backlog without publishing the same row twice.
+    '''
+    (select_sql_query, select_params), lease_query_builder = build_claim_queries(worker_id, after_id, batch_size)
+    mysql_cursor.execute(select_sql_query, select_params)
+    records: list = [dict(zip(OUTBOX_COLUMNS, record)) for record in mysql_cursor.fetchall()]
+
+    if records:
+        mysql_cursor.execute(*lease_query_builder([record['id'] for record in records]))
+
+    mysql_connection.commit()    # ? Releases the row locks, the lease keeps the claim.
+    return records
+
+
+def build_status_update_queries(publish_results: dict, worker_id: str) -> tuple:
+    '''
+    Set based, parameterized UPDATEs for the status transitions of a whole window. Rows without error are grouped by status into `WHERE id IN (...)`,
+    rows with an error message are updated with a `CASE id WHEN ... THEN ... END` carrying their own message, and rescheduled (see pubsub/retry.py).
+    The lease of the rows is released at the same time. Rows whose lease was taken over by another worker are left alone.
+    Rows with a None status were not attempted, only their lease is released.
+    Returns ([(sql, params), ...], {status: [ids]}).
+    '''
+    ids_by_status: dict = {}
+    error_msgs_by_id: dict = {}
+    released_ids: list = []
+    for record_id, (msg_publish_status, error_msg) in publish_results.items():
+        if msg_publish_status is None:
+            released_ids.append(record_id)
+        elif error_msg:
+            error_msgs_by_id[record_id] = error_msg
+        else:
+            ids_by_status.setdefault(msg_publish_status, []).append(record_id)
+
+    update_queries: list = []
+    for msg_publish_status, record_ids in ids_by_status.items():
+        update_sql_query = f"UPDATE {MYSQL_DB}.{QUEUE_HISTORY_TABLE_NAME} SET status = %s, lease_owner = NULL, lease_expires_at = NULL"
+        update_sql_query += f" WHERE id IN ({', '.join(['%s'] * len(record_ids))}) AND lease_owner = %s"
+        update_queries.append((update_sql_query, (msg_publish_status, *record_ids, worker_id)))
+
+    if error_msgs_by_id:    # ? Rescheduled with backoff, `failed` once out of attempts.
+        retry_assignments_sql, retry_params = build_retry_assignments('error')
+        update_sql_query = f"UPDATE {MYSQL_DB}.{QUEUE_HISTORY_TABLE_NAME} SET lease_owner = NULL, lease_expires_at = NULL"
+        update_sql_query += f" , error_msg = CASE id {' '.join(['WHEN %s THEN %s'] * len(error_msgs_by_id))} END"
+        update_sql_query += f" , {retry_assignments_sql}"
+        update_sql_query += f" WHERE id IN ({', '.join(['%s'] * len(error_msgs_by_id))}) AND lease_owner = %s"
+        case_params: list = [param for record_id, error_msg in error_msgs_by_id.items() for param in (record_id, error_msg)]
+        update_queries.append((update_sql_query, (*case_params, *retry_params, *error_msgs_by_id.keys(), worker_id)))
+        ids_by_status.setdefault('error', []).extend(error_msgs_by_id.keys())
+
+    if released_ids:    # ? Not a status transition, left out of ids_by_status.
+        update_sql_query = f"UPDATE {MYSQL_DB}.{QUEUE_HISTORY_TABLE_NAME} SET lease_owner = NULL, lease_expires_at = NULL"
+        update_sql_query += f" WHERE id IN ({', '.join(['%s'] * len(released_ids))}) AND lease_owner = %s"
+        update_queries.append((update_sql_query, (*released_ids, worker_id)))
+
+    return update_queries, ids_by_status
+
+
+def record_status_transitions(ids_by_status: dict) -> int:
+    transitions_count: int = sum(len(record_ids) for record_ids in ids_by_status.values())
+    for msg_publish_status, record_ids in ids_by_status.items():
+        OUTBOX_STATUS_TRANSITIONS.labels(status=msg_publish_status).inc(len(record_ids))
+    OUTBOX_STATUS_FLUSH_SIZE.observe(transitions_count)
+    ash_logger.info(f'Flushed {transitions_count} status transitions ---> ' + ', '.join(f'{status}: {len(ids)}' for status, ids in ids_by_status.items()))
+    return transitions_count
+
+
+def flush_status_updates(mysql_connection, mysql_cursor, publish_results: dict, worker_id: str) -> int:
+    '''
+    Writes the status transitions of a whole window with a few set based UPDATEs (see build_status_update_queries()) and a single commit,
+    instead of one UPDATE + commit per row. Returns the number of transitions flushed.
+    '''
+    if not publish_results:
+        return 0
+
+    update_queries, ids_by_status = build_status_update_queries(publish_results, worker_id)
+    for update_sql_query, update_params in update_queries:
+        mysql_cursor.execute(update_sql_query, update_params)
+    mysql_connection.commit()
+
+    return record_status_transitions(ids_by_status)
+
+
+class OutboxWakeupListener:
+    '''
+    Listens for the UDP nudges sent on commit of every new outbox row, and wakes up all the relay workers of this process.
+    SO_REUSEPORT lets several relay processes on the same host bind the same port, the kernel hands each nudge to one of them.
+    '''
+
+    def __init__(self, host: str = OUTBOX_WAKEUP_HOST, port: int = OUTBOX_WAKEUP_PORT):
+        self.host = host
+        self.port = port
+        self.nudge_count: int = 0
+        self.condition = threading.Condition()
+
+    def start(self) -> None:
+        if not self.port:
+            return
+        try:
+            wakeup_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                wakeup_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            wakeup_socket.bind((self.host, self.port))
+        except OSError as e:
+            ash_logger.info(f'Could not listen for outbox nudges on {self.host}:{self.port}, falling back to polling only -----> {str(e)}')
+            return
+        threading.Thread(target=self._listen, args=(wakeup_socket,), name='outbox-wakeup-listener', daemon=True).start()
+
+    def _listen(self, wakeup_socket) -> None:
+        while True:
+            try:
+                _ = wakeup_socket.recv(64)
+            except OSError:
+                continue
+            with self.condition:
+                self.nudge_count += 1
+                self.condition.notify_all()
+
+    def wait(self, timeout_secs: float, seen_nudge_count: int) -> int:
+        '''
+        Blocks until a nudge newer than `seen_nudge_count` arrives or the timeout elapses. Returns the latest nudge count.
+        '''
+        with self.condition:
+            self.condition.wait_for(lambda: self.nudge_count != seen_nudge_count, timeout=timeout_secs)
+            return self.nudge_count
+
+
+outbox_wakeup_listener = OutboxWakeupListener()
+
+
+def run_relay_worker(worker_id: str) -> None:
+    mysql_connection, mysql_cursor = None, None
+    poll_interval: float = OUTBOX_MIN_POLL_INTERVAL
+    seen_nudge_count: int = 0
     while True:
         try:
-            mysql_connection, mysql_cursor = connect_to_mysql()
-
-            sql_query = f"SELECT * FROM {MYSQL_DB}.{QUEUE_HISTORY_TABLE_NAME}"
-            sql_query += f" WHERE status in {str(STATUS_TO_PUBLISH)}"
-            mysql_cursor.execute(sql_query)
-            records = mysql_cursor.fetchall()
-
-            if records:
-                columns = [column[0] for column in mysql_cursor.description]
-                all_data_list = list()
-                for i, record in enumerate(records):
-                    data = dict(zip(columns, record))
-                    all_data_list.append(data)
-
-                # for record in records:
-                for i, record in enumerate(all_data_list):
-                    # print(f'Publishing {i+1}/{len(all_data_list)} ---> id: {record["id"]}, queue: {record["queue_name"]}, exchange: {record["exchange_name"]}, message_id: {record["message_id"]}')
-                    ash_logger.info(f'Publishing {i+1}/{len(all_data_list)} ---> id: {record["id"]}, queue: \'{record["queue_name"]}\', exchange: \'{record["exchange_name"]}\', message_id: \'{record["message_id"]}\'')
-                    # Process and publish each record to RabbitMQ
-                    status_bool, error_msg = publish_msg_to_rabbitmq(
-                                                queue_name = record["queue_name"]
-                                                , exchange_name = record["exchange_name"]
-                                                , deadletter_queue_name = record["deadletter_queue_name"]
-                                                , deadletter_exchange_name = record["deadletter_exchange_name"]
-                                                , message_body = record["message_body_json"]
-                                                , delivery_mode = record["delivery_mode"]
-                                                , expiration_secs = record["expiration_secs"]
-                                                , message_id = record["message_id"]
-                                )
-
-                    # Mark the record as published or error in MySQL publish history table.
-                    msg_publish_status = 'error' if error_msg else 'published'
-                    update_sql_query = f"UPDATE {MYSQL_DB}.{QUEUE_HISTORY_TABLE_NAME} SET status = '{msg_publish_status}'"
-                    if error_msg:
-                        update_sql_query += f" , error_msg = '{error_msg}'"
-                    update_sql_query += f" WHERE id = {record['id']}"
-
-                    mysql_cursor.execute(update_sql_query)
-                    mysql_connection.commit()
-
-
-            mysql_cursor.close()
-            mysql_connection.close()
+            if mysql_connection is None:    # ? Kept open across cycles, a wakeup should not pay for a new MySQL connection.
+                mysql_connection, mysql_cursor = connect_to_mysql()
 
-            time.sleep(SLEEP_INTERVAL)
+            published_anything: bool = False
+            last_id: int = 0
+            while True:
+                records: list = claim_outbox_batch(mysql_connection, mysql_cursor, worker_id, after_id=last_id)
+                if not records:
+                    break
+                last_id = records[-1]['id']
+                published_anything = True
+
+                for window_start in range(0, len(records), PUBLISH_CONFIRM_WINDOW):
+                    window = records[window_start: window_start + PUBLISH_CONFIRM_WINDOW]
+                    ash_logger.info(f'[{worker_id}] Publishing {len(window)} msgs ---> ids: {window[0]["id"]}..{window[-1]["id"]}')
+                    publish_results: dict = publish_window(window)
+
+                    # Mark the records as published or error in MySQL publish history table.
+                    _ = flush_status_updates(mysql_connection, mysql_cursor, publish_results, worker_id)
+
+                if len(records) < OUTBOX_FETCH_BATCH_SIZE:
+                    break    # ? Last (partial) batch, no need for one more empty round trip.
+
+            # * Adaptive backoff: poll again quickly while there is traffic, slow down while idle. A nudge cuts the wait short anyway.
+            poll_interval = OUTBOX_MIN_POLL_INTERVAL if published_anything else min(poll_interval * 2, OUTBOX_MAX_POLL_INTERVAL)
+            seen_nudge_count = outbox_wakeup_listener.wait(poll_interval, seen_nudge_count)
 
         except Exception as e:
             # print(f"An error occurred: {e}")
-            ash_logger.info(f"An ERROR occurred:- {e}")
+            ash_logger.info(f"[{worker_id}] An ERROR occurred:- {e}")
+            try:
+                mysql_connection.close()
+            except Exception:
+                pass
+            mysql_connection, mysql_cursor = None, None
+            time.sleep(SLEEP_INTERVAL)
 
 
-if __name__ == '__main__':
-    main()
+def main():
+    worker_id_prefix: str = f'{socket.gethostname()}:{os.getpid()}'
+    outbox_wakeup_listener.start()
+    if RELAY_WORKERS <= 1:
+        run_relay_worker(f'{worker_id_prefix}:0')
+        return
+
+    # * Each worker thread has its own MySQL connection and RabbitMQ session. Rows are split between them by claiming.
+    worker_threads: list = [
+        threading.Thread(target=run_relay_worker, args=(f'{worker_id_prefix}:{i}',), name=f'outbox-relay-{i}', daemon=True)
+        for i in range(RELAY_WORKERS)
+    ]
+    for worker_thread in worker_threads:
+        worker_thread.start()
+    for worker_thread in worker_threads:
+        worker_thread.join()
 
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Outbox relay, publishes the rows of `queue_publish_history` to RabbitMQ.')
+    parser.add_argument('--engine', choices=('sync', 'async'), default=os.environ.get('OUTBOX_RELAY_ENGINE', 'sync')
+                        , help='sync: pika + pymysql worker threads. async: asyncio engine (aio-pika + aiomysql), see producer_service_async.py.')
+    args = parser.parse_args()
+
+    if RELAY_METRICS_PORT:
+        start_http_server(RELAY_METRICS_PORT)
+
+    if args.engine == 'async':
+        import asyncio
+        sys.modules.setdefault('producer_service', sys.modules[__name__])    # ? producer_service_async imports the helpers of this module, don't let it execute (and re-register the metrics of) a second copy.
+        from producer_service_async import async_main
+        asyncio.run(async_main())
+    else:
+        main()
@@ -0,0 +1,256 @@
+'''
+    Purpose: asyncio engine of the outbox relay, selected with `python producer_service.py --engine=async`.
+    The claim of the next batch, the publishes (thousands in flight, each one confirmed by the broker), and the status flush of the previous batches
+    all overlap, instead of running one after the other like in the sync engine.
+    Uses the same claim protocol, SQL, metrics and wakeup nudges as producer_service.py, so both engines can even run side by side.
+    Requires: `pip install aio-pika aiomysql`.
+'''
+
+import os
+import socket
+import asyncio
+
+import aio_pika
+import aiomysql
+
+import producer_service as relay
+from producer_service import ash_logger
+from pubsub.codecs import encode_message_body
+
+
+OUTBOX_ASYNC_MAX_IN_FLIGHT: int = int(os.environ.get('OUTBOX_ASYNC_MAX_IN_FLIGHT', 5000))    # Max. unconfirmed publishes at once.
+OUTBOX_ASYNC_PREFETCH_BATCHES: int = 2    # ? Claimed batches waiting to be published. Keeps the publisher busy while bounding memory.
+
+
+class OutboxWakeupProtocol(asyncio.DatagramProtocol):
+    def __init__(self, wakeup_event: asyncio.Event):
+        self.wakeup_event = wakeup_event
+
+    def datagram_received(self, data, addr) -> None:
+        self.wakeup_event.set()
+
+
+async def listen_for_wakeups(wakeup_event: asyncio.Event) -> None:
+    if not relay.OUTBOX_WAKEUP_PORT:
+        return
+    try:
+        _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                                                lambda: OutboxWakeupProtocol(wakeup_event)
+                                                , local_addr=(relay.OUTBOX_WAKEUP_HOST, relay.OUTBOX_WAKEUP_PORT)
+                                                , reuse_port=hasattr(socket, 'SO_REUSEPORT')
+                                            )
+    except OSError as e:
+        ash_logger.info(f'Could not listen for outbox nudges on {relay.OUTBOX_WAKEUP_HOST}:{relay.OUTBOX_WAKEUP_PORT}, falling back to polling only -----> {str(e)}')
+
+
+async def connect_to_rabbitmq_async() -> aio_pika.abc.AbstractRobustConnection:
+    # ? Robust connection: reconnects by itself and restores the declared exchanges / queues.
+    return await aio_pika.connect_robust(
+                            host=relay.RABBITMQ_HOST
+                            , port=relay.RABBITMQ_PORT
+                            , virtualhost=relay.RABBITMQ_VHOST
+                            , login=relay.RABBITMQ_USERNAME
+                            , password=relay.RABBITMQ_PASSWORD
+                        )
+
+
+async def declare_topology_async(channel, declared_exchanges: dict, record: dict):
+    topology_key: tuple = (record['queue_name'], record['exchange_name'], record['deadletter_queue_name'], record['deadletter_exchange_name'])
+    if topology_key not in declared_exchanges:
+        deadletter_exchange = await channel.declare_exchange(record['deadletter_exchange_name'], aio_pika.ExchangeType.DIRECT)
+        deadletter_queue = await channel.declare_queue(record['deadletter_queue_name'], durable=True)
+        await deadletter_queue.bind(deadletter_exchange, routing_key='')
+
+        exchange = await channel.declare_exchange(record['exchange_name'], aio_pika.ExchangeType.DIRECT)
+        queue = await channel.declare_queue(record['queue_name'], durable=True, arguments={"x-dead-letter-exchange": record['deadletter_exchange_name']})
+        await queue.bind(exchange, routing_key='')
+
+        declared_exchanges[topology_key] = exchange
+    return declared_exchanges[topology_key]
+
+
+async def publish_record_async(exchange, record: dict, in_flight_semaphore: asyncio.Semaphore) -> tuple:
+    async with in_flight_semaphore:
+        try:
+            # ? The channel is in publisher confirms mode, so this returns once the broker acked it, and raises if it was nacked / returned / lost.
+            body, content_type = encode_message_body(record['message_body_json'], relay.OUTBOX_WIRE_FORMAT)
+            await exchange.publish(
+                            aio_pika.Message(
+                                body=body
+                                , content_type=content_type
+                                , delivery_mode=record['delivery_mode']
+                                , message_id=str(record['message_id'])
+                                , expiration=record['expiration_secs']    # Seconds, converted to milliseconds by aio-pika.
+                            )
+                            , routing_key=''    # Empty routing key to send to the bound queue directly.
+                        )
+        except Exception as e:
+            return record['id'], ('error', str(e) or e.__class__.__name__)
+        return record['id'], ('published', None)
+
+
+async def publish_window_async(channel, declared_exchanges: dict, records: list, in_flight_semaphore: asyncio.Semaphore) -> dict:
+    '''
+    Publishes a batch with all its messages in flight at once (bounded by the semaphore). Returns {row id: (status, error_msg)}, same as publish_window().
+    '''
+    publish_results: dict = {}
+    exchanges: list = []
+    for record in records:
+        try:
+            exchanges.append(await declare_topology_async(channel, declared_exchanges, record))
+        except Exception as e:
+            exchanges.append(None)
+            publish_results[record['id']] = ('error', str(e))
+
+    publish_results.update(await asyncio.gather(*(
+                                publish_record_async(exchange, record, in_flight_semaphore)
+                                for exchange, record in zip(exchanges, records) if exchange is not None
+                            )))
+    return publish_results
+
+
+async def claim_outbox_batch_async(mysql_pool, worker_id: str, after_id: int) -> list:
+    (select_sql_query, select_params), lease_query_builder = relay.build_claim_queries(worker_id, after_id, relay.OUTBOX_FETCH_BATCH_SIZE)
+    async with mysql_pool.acquire() as mysql_connection:
+        async with mysql_connection.cursor() as mysql_cursor:
+            await mysql_cursor.execute(select_sql_query, select_params)
+            records: list = [dict(zip(relay.OUTBOX_COLUMNS, record)) for record in await mysql_cursor.fetchall()]
+            if records:
+                await mysql_cursor.execute(*lease_query_builder([record['id'] for record in records]))
+        await mysql_connection.commit()    # ? Releases the row locks, the lease keeps the claim.
+    return records
+
+
+async def claim_batches(mysql_pool, worker_id: str, batch_queue: asyncio.Queue, wakeup_event: asyncio.Event) -> None:
+    poll_interval: float = relay.OUTBOX_MIN_POLL_INTERVAL
+    while True:
+        claimed_anything: bool = False
+        try:
+            last_id: int = 0
+            while True:
+                records: list = await claim_outbox_batch_async(mysql_pool, worker_id, after_id=last_id)
+                if not records:
+                    break
+                last_id = records[-1]['id']
+                claimed_anything = True
+                await batch_queue.put(records)    # ? Blocks while the publisher is behind, the publisher only takes a batch when one of its OUTBOX_ASYNC_PREFETCH_BATCHES slots is free.
+                if len(records) < relay.OUTBOX_FETCH_BATCH_SIZE:
+                    break
+        except Exception as e:
+            ash_logger.info(f"[{worker_id}] An ERROR occurred while claiming:- {e}")
+            await asyncio.sleep(relay.SLEEP_INTERVAL)
+            continue
+
+        # * Adaptive backoff, same as the sync engine. A nudge cuts the wait short.
+        poll_interval = relay.OUTBOX_MIN_POLL_INTERVAL if claimed_anything else min(poll_interval * 2, relay.OUTBOX_MAX_POLL_INTERVAL)
+        try:
+            await asyncio.wait_for(wakeup_event.wait(), timeout=poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        wakeup_event.clear()
+
+
+async def publish_batches(rabbitmq_connection, batch_queue: asyncio.Queue, flush_queue: asyncio.Queue, batch_slots: asyncio.Semaphore) -> None:
+    channel = await rabbitmq_connection.channel(publisher_confirms=True)
+    declared_exchanges: dict = {}
+    in_flight_semaphore = asyncio.Semaphore(OUTBOX_ASYNC_MAX_IN_FLIGHT)
+    publishing_tasks: set = set()
+
+    async def publish_and_hand_over(records: list) -> None:
+        try:
+            publish_results: dict = await publish_window_async(channel, declared_exchanges, records, in_flight_semaphore)
+        except Exception as e:
+            # ? Rows stay claimed until their lease expires, then they are published again (at least once delivery).
+            ash_logger.info(f'An ERROR occurred while publishing ids {records[0]["id"]}..{records[-1]["id"]}:- {e}')
+            batch_slots.release()
+            return
+        await flush_queue.put(publish_results)    # ? flush_batches releases the slot once flushed.
+
+    try:
+        while True:
+            # * A slot is held from before the batch is taken until its statuses are flushed. Otherwise batch_queue is drained at once, the claimer leases
+            # * the whole backlog and the rows still waiting after OUTBOX_LEASE_SECS are claimed again by this same worker_id, then published twice.
+            await batch_slots.acquire()
+            records: list = await batch_queue.get()
+            ash_logger.info(f'Publishing {len(records)} msgs ---> ids: {records[0]["id"]}..{records[-1]["id"]}')
+            # ? Not awaited here, the next batch starts publishing while this one is still waiting for its confirms.
+            publishing_task = asyncio.create_task(publish_and_hand_over(records))
+            publishing_tasks.add(publishing_task)
+            publishing_task.add_done_callback(publishing_tasks.discard)
+    finally:
+        for publishing_task in publishing_tasks:
+            publishing_task.cancel()
+
+
+async def flush_batches(mysql_pool, worker_id: str, flush_queue: asyncio.Queue, batch_slots: asyncio.Semaphore) -> None:
+    while True:
+        publish_results: dict = await flush_queue.get()
+        try:
+            if not publish_results:
+                continue
+            update_queries, ids_by_status = relay.build_status_update_queries(publish_results, worker_id)
+            try:
+                async with mysql_pool.acquire() as mysql_connection:
+                    async with mysql_connection.cursor() as mysql_cursor:
+                        for update_sql_query, update_params in update_queries:
+                            await mysql_cursor.execute(update_sql_query, update_params)
+                    await mysql_connection.commit()
+            except Exception as e:
+                # ? Rows stay claimed until their lease expires, then they are published again (at least once delivery).
+                ash_logger.info(f"[{worker_id}] An ERROR occurred while flushing:- {e}")
+                continue
+            _ = relay.record_status_transitions(ids_by_status)
+        finally:
+            batch_slots.release()
+
+
+async def async_main() -> None:
+    worker_id: str = f'{socket.gethostname()}:{os.getpid()}:async'
+    wakeup_event = asyncio.Event()
+    await listen_for_wakeups(wakeup_event)
+
+    while True:
+        try:
+            mysql_pool = await aiomysql.create_pool(
+                                        host=relay.MYSQL_HOST
+                                        , port=relay.MYSQL_PORT
+                                        , user=relay.MYSQL_USER
+                                        , password=relay.MYSQL_PASSWORD
+                                        , db=relay.MYSQL_DB
+                                        , autocommit=False
+                                        , minsize=2    # One for claiming, one for flushing.
+                                        , maxsize=4
+                                    )
+            rabbitmq_connection = await connect_to_rabbitmq_async()
+        except Exception as e:
+            ash_logger.info(f"Connection to MySQL / RabbitMQ failed. Retrying in {relay.SLEEP_INTERVAL} seconds... -----> {e}")
+            await asyncio.sleep(relay.SLEEP_INTERVAL)
+            continue
+
+        batch_queue = asyncio.Queue(maxsize=1)    # ? Handoff only, the limit is batch_slots.
+        flush_queue = asyncio.Queue()
+        batch_slots = asyncio.Semaphore(OUTBOX_ASYNC_PREFETCH_BATCHES)    # ? Batches taken by the publisher and not yet flushed.
+        ash_logger.info(f' [*] [{worker_id}] Async outbox relay started.')
+
+        relay_tasks: list = [
+                            asyncio.create_task(claim_batches(mysql_pool, worker_id, batch_queue, wakeup_event))
+                            , asyncio.create_task(publish_batches(rabbitmq_connection, batch_queue, flush_queue, batch_slots))
+                            , asyncio.create_task(flush_batches(mysql_pool, worker_id, flush_queue, batch_slots))
+                        ]
+        try:
+            # ? Unlike gather(), the other loops don't keep running against the closed pool / connection when one of them fails.
+            done, _ = await asyncio.wait(relay_tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for relay_task in done:
+                ash_logger.info(f"[{worker_id}] An ERROR occurred:- {relay_task.exception()}")
+        finally:
+            for relay_task in relay_tasks:
+                relay_task.cancel()
+            _ = await asyncio.gather(*relay_tasks, return_exceptions=True)
+            mysql_pool.close()
+            await mysql_pool.wait_closed()
+            await rabbitmq_connection.close()
+        await asyncio.sleep(relay.SLEEP_INTERVAL)
+
+
+if __name__ == '__main__':
+    asyncio.run(async_main())
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import QueuePublishHistory    #, ExpiredRejectedLog
+from .models import QueuePublishHistory, QueuePublishHistoryArchive, DeadLetterQueue    #, ExpiredRejectedLog
 
 
 @admin.register(QueuePublishHistory)
@@ -7,4 +7,22 @@ class QueuePublishHistory(admin.ModelAdmin):
     list_display = [field.name for field in QueuePublishHistory._meta.fields]
     search_fields = ('queue_name', 'exchange_name', 'deadletter_queue_name', 'deadletter_exchange_name', 'status', 'message_id', 'error_msg')
     readonly_fields = ['message_id', 'timestamp']
+    actions = ['requeue']
 
+    @admin.action(description='Requeue selected rows for publishing (resets their attempts)')
+    def requeue(self, request, queryset):
+        updated_count = queryset.exclude(status='published').update(status='pending', attempt_count=0, next_attempt_at=None)
+        self.message_user(request, f'{updated_count} rows requeued.')
+
+
+@admin.register(QueuePublishHistoryArchive)
+class QueuePublishHistoryArchive(admin.ModelAdmin):
+    list_display = [field.name for field in QueuePublishHistoryArchive._meta.fields]
+    search_fields = ('queue_name', 'exchange_name', 'status', 'message_id')
+    readonly_fields = [field.name for field in QueuePublishHistoryArchive._meta.fields]
+
+
+@admin.register(DeadLetterQueue)
+class DeadLetterQueue(admin.ModelAdmin):
+    list_display = [field.name for field in DeadLetterQueue._meta.fields]
+    search_fields = ('queue_name', 'exchange_name')
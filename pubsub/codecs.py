@@ -0,0 +1,62 @@
+'''
+Purpose: One canonical encoding of the RabbitMQ message bodies, shared by the producer (producer_service.py, producer_service_async.py) and the consumers.
+    - `application/json` (default): the JSON text stored in `queue_publish_history.message_body_json` is published as is, and decoded once by the consumer.
+      orjson is used when installed, else the stdlib json.
+    - `application/msgpack` (opt-in, `OUTBOX_WIRE_FORMAT=msgpack`, needs msgpack): smaller and faster to decode.
+    The consumer picks the decoder from the message `content_type`, so both formats can be in a queue at the same time.
+NB: No Django imports in here, producer_service.py does not call django.setup().
+'''
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON_CONTENT_TYPE: str = 'application/json'
+MSGPACK_CONTENT_TYPE: str = 'application/msgpack'
+WIRE_FORMATS: tuple = ('json', 'msgpack')
+
+
+def loads_json(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def dumps_json(data) -> bytes:
+    return orjson.dumps(data) if orjson else json.dumps(data).encode('utf-8')
+
+
+def encode_message_body(message_body, wire_format: str = 'json') -> tuple:
+    '''
+    message_body: Outbox row value. JSON text (str / bytes) as returned by the MySQL drivers, or an already decoded python object.
+    Returns (body bytes, content_type).
+    '''
+    if wire_format == 'msgpack':
+        if msgpack is None:
+            raise ImportError('OUTBOX_WIRE_FORMAT=msgpack needs `pip install msgpack`.')
+        data = loads_json(message_body) if isinstance(message_body, (str, bytes)) else message_body
+        return msgpack.packb(data, use_bin_type=True), MSGPACK_CONTENT_TYPE
+
+    # ? Already JSON, published as is. Dumping it again would wrap it in a JSON string, which costs a second decode on the consumer side.
+    if isinstance(message_body, str):
+        return message_body.encode('utf-8'), JSON_CONTENT_TYPE
+    if isinstance(message_body, bytes):
+        return message_body, JSON_CONTENT_TYPE
+    return dumps_json(message_body), JSON_CONTENT_TYPE
+
+
+def decode_message_body(body: bytes, content_type: str = None):
+    if content_type == MSGPACK_CONTENT_TYPE:
+        return msgpack.unpackb(body, raw=False)
+
+    decoded = loads_json(body)
+    if isinstance(decoded, str):    # ? Legacy double encoded body (JSON string holding the JSON object), published before the single encoding. Still in the queues.
+        decoded = loads_json(decoded)
+    return decoded
@@ -0,0 +1,27 @@
+'''
+    Usage: python manage.py backfill_deadletter_queues
+'''
+
+from django.core.management.base import BaseCommand
+
+from pubsub.models import QueuePublishHistory, QueuePublishHistoryArchive, DeadLetterQueue
+
+
+class Command(BaseCommand):
+    '''
+        Usage: `python manage.py backfill_deadletter_queues`
+        One off, fills the `DeadLetterQueue` registry from the deadletter queues of the existing outbox rows. New rows register their queue themselves.
+    '''
+    help = 'Register the deadletter queues of the existing queue_publish_history rows'
+
+    def handle(self, *args, **options):
+        deadletter_queues: dict = {}
+        for model in (QueuePublishHistory, QueuePublishHistoryArchive):
+            for queue_name, exchange_name in model.objects.exclude(deadletter_queue_name=None).values_list('deadletter_queue_name', 'deadletter_exchange_name').distinct():
+                deadletter_queues.setdefault(queue_name, exchange_name)
+
+        created = DeadLetterQueue.objects.bulk_create(
+                                            [DeadLetterQueue(queue_name=queue_name, exchange_name=exchange_name) for queue_name, exchange_name in deadletter_queues.items()]
+                                            , ignore_conflicts=True
+                                        )
+        self.stdout.write(self.style.SUCCESS(f'{len(created)} deadletter queues registered.'))
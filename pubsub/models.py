@@ -3,12 +3,13 @@ import uuid
 import drf_signal_simplejwt.base_functions as base_f
 
 
-class QueuePublishHistory(models.Model):
+class QueuePublishHistoryAbstract(models.Model):
     STATUS_CHOICES = (
                     ('pending', 'pending'),    # Auto requeued.
                     ('published', 'published'),
                     ('error', 'error'),    # Auto requeued.
                     ('expired', 'expired'),    # Auto requeued.
+                    ('failed', 'failed'),    # ? Terminal, out of attempts (pubsub/retry.py). Requeue manually from the admin.
                 )
     queue_name = models.TextField(null=True)
     exchange_name = models.TextField(null=True)
@@ -20,12 +21,78 @@ class QueuePublishHistory(models.Model):
     message_id = models.UUIDField(default=uuid.uuid4, editable=False)    # * Non-Editable in django forms or django admin.
 
     timestamp = models.DateTimeField(auto_now_add=True, null=True)
-    status = models.TextField(choices=STATUS_CHOICES, default='pending')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')    # ? CharField, as MySQL can't index a TEXT column without a prefix length.
     error_msg = models.TextField(default='')
 
+    # * Retry schedule of the `error` / `expired` rows, see pubsub/retry.py.
+    attempt_count = models.IntegerField(default=0)    # Failed publish attempts so far (publish error or expired / rejected message).
+    next_attempt_at = models.DateTimeField(blank=True, null=True)    # ? Not republished before this. Null: due right away.
+
+    # * Claim protocol of producer_service.py, so multiple relay workers can split the backlog. Set while a worker is publishing the row, cleared with the status update.
+    lease_owner = models.CharField(max_length=255, blank=True, null=True)    # <hostname>:<pid>:<worker no.>
+    lease_expires_at = models.DateTimeField(blank=True, null=True)    # ? Expired leases (worker died) are reclaimed by the other workers.
+
+    class Meta:
+        abstract = True
+
+    def __str__(self):
+        return str(self.message_id)
+
+
+class QueuePublishHistory(QueuePublishHistoryAbstract):
+
     class Meta:
         db_table = 'queue_publish_history'
 
+        # ! After adding indexing in the model, we need to run `python manage.py makemigrations` and `python manage.py migrate` to create the index in the database.
+        indexes = [
+            models.Index(fields=['status', 'id'], name='idx_qph_status_id'),    # ? Relay keyset pagination, `WHERE status IN (...) AND id > %s ORDER BY id`. Also the archival job walks `published` rows in id order. Being the leftmost column, plain `status` filters use it too, so no separate index on `status`.
+            models.Index(fields=['message_id'], name='idx_qph_message_id'),     # deadletter_consumer.py marks rows as expired by message_id.
+        ]
+
+
+'''
+Purpose: `published` rows older than `QUEUE_PUBLISH_HISTORY_RETENTION_DAYS` days are moved here by the `archive_published_queue_history` task,
+so the hot `queue_publish_history` table scanned by the relay only holds the recent / unpublished rows. Rows keep their original id.
+'''
+class QueuePublishHistoryArchive(QueuePublishHistoryAbstract):
+    timestamp = models.DateTimeField(null=True)    # Copied as is from the hot table, not auto_now_add.
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'queue_publish_history_archive'
+        indexes = [
+            models.Index(fields=['message_id'], name='idx_qpha_message_id'),
+        ]
+
+
+'''
+Purpose: message_ids already applied by a consumer (user_sync_consumer.py), inserted in the same transaction as the changes of the message.
+So redeliveries / relay retries of a message are dropped without touching the synced tables. Lives in the consuming project's DB, install the `pubsub` app there.
+NB: Only needs to outlive the redelivery window of a message, rows older than `PROCESSED_MESSAGE_RETENTION_DAYS` days are deleted by the `purge_processed_messages` task.
+'''
+class ProcessedMessage(models.Model):
+    message_id = models.CharField(max_length=64, unique=True)    # ? AMQP message_id as received (the outbox uuid). The unique index serves the dedup lookup.
+    processed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'processed_message'
+
     def __str__(self):
         return str(self.message_id)
 
+
+'''
+Purpose: Registry of the deadletter queues ever used by an outbox row, filled by `queue_msg_to_publish()`.
+deadletter_consumer.py reads it at startup and polls it for new queues, instead of a `SELECT DISTINCT` over the whole `queue_publish_history`.
+'''
+class DeadLetterQueue(models.Model):
+    queue_name = models.CharField(max_length=255, unique=True)
+    exchange_name = models.CharField(max_length=255, blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'deadletter_queue'
+
+    def __str__(self):
+        return self.queue_name
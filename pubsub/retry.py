@@ -0,0 +1,28 @@
+'''
+Purpose: Retry policy of the outbox rows, shared by producer_service.py (publish errors) and deadletter_consumer.py (expired / rejected messages).
+Every failed attempt pushes `next_attempt_at` back exponentially, with jitter so the rows failed together are not all retried at the same second,
+and the row turns `failed` (terminal, not republished any more) after OUTBOX_MAX_ATTEMPTS attempts.
+NB: No Django imports in here, the relay runs on plain pymysql.
+'''
+
+import os
+
+
+OUTBOX_MAX_ATTEMPTS: int = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 8))    # ? Publish attempts before a row is marked `failed`.
+OUTBOX_RETRY_BASE_SECS: int = int(os.environ.get('OUTBOX_RETRY_BASE_SECS', 10))    # Delay after the 1st failed attempt, doubled after each next one.
+OUTBOX_RETRY_MAX_SECS: int = int(os.environ.get('OUTBOX_RETRY_MAX_SECS', 60 * 60))    # Cap of the delay.
+
+# ? Equal jitter: somewhere between half and all of min(cap, base * 2^attempt_count). Computed by MySQL from the current attempt_count of each row, so a whole batch is rescheduled by one UPDATE.
+NEXT_ATTEMPT_AT_SQL: str = "UTC_TIMESTAMP() + INTERVAL ROUND(LEAST(%s, %s * POW(2, attempt_count)) * (0.5 + RAND() / 2)) SECOND"
+NEXT_ATTEMPT_AT_PARAMS: tuple = (OUTBOX_RETRY_MAX_SECS, OUTBOX_RETRY_BASE_SECS)
+
+
+def build_retry_assignments(retry_status: str) -> tuple:
+    '''
+    Returns the (sql, params) of the `SET` assignments recording one more failed attempt: `retry_status` (or `failed` if out of attempts), next_attempt_at, attempt_count.
+    ! MySQL evaluates single table UPDATE assignments left to right, each one seeing the previous ones. attempt_count must stay the last one, so the others read its old value.
+    '''
+    assignments_sql = "status = CASE WHEN attempt_count + 1 >= %s THEN 'failed' ELSE %s END"
+    assignments_sql += f", next_attempt_at = {NEXT_ATTEMPT_AT_SQL}"
+    assignments_sql += ", attempt_count = attempt_count + 1"
+    return assignments_sql, (OUTBOX_MAX_ATTEMPTS, retry_status, *NEXT_ATTEMPT_AT_PARAMS)
@@ -0,0 +1,16 @@
+'''
+Purpose: Stable key -> shard mapping, shared by the producer side (signal) and the consumers, to keep the messages of one user in order while spreading users over workers / queues.
+NB: No Django imports in here, copy it along with user_sync_consumer.py.
+'''
+
+import zlib
+
+
+def shard_for_key(key, shard_count: int) -> int:
+    # ? crc32 instead of hash(), which is salted per process for str and would send the same user to different shards on different processes / hosts.
+    return zlib.crc32(str(key).encode('utf-8')) % shard_count
+
+
+def partition_name(base_name: str, partition: int) -> str:
+    # ? Queue / exchange of a partition, e.g. `drf_queue.p3`. Each partition gets its own direct exchange, so the relay's empty routing key binding still fans out to exactly one queue.
+    return f'{base_name}.p{partition}'
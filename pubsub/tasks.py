@@ -0,0 +1,17 @@
+# ? Registered in drf_signal_simplejwt/registered_tasks.py, runs with `python manage.py dj_tasks_scheduler`.
+
+from background_task import background
+
+from pubsub.utils import archive_published_queue_history, purge_processed_messages
+
+
+@background
+def archive_published_queue_history_task():
+    archived_count = archive_published_queue_history()
+    print(f'Archived {archived_count} published rows of queue_publish_history.')
+
+
+@background
+def purge_processed_messages_task():
+    purged_count = purge_processed_messages()
+    print(f'Purged {purged_count} rows of processed_message.')
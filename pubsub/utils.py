@@ -1,4 +1,70 @@
-from .models import QueuePublishHistory
+import socket
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import QueuePublishHistory, QueuePublishHistoryArchive, DeadLetterQueue, ProcessedMessage
+
+
+_outbox_wakeup_socket = None
+
+
+def nudge_outbox_relay() -> None:
+    '''
+    Fire and forget UDP datagram to producer_service.py, so it publishes the new outbox rows right away instead of at its next poll.
+    Best effort only: if no relay is listening the datagram is simply lost and the relay's fallback polling picks the rows up.
+    '''
+    global _outbox_wakeup_socket
+    if not settings.RABBITMQ['OUTBOX_WAKEUP_PORT']:
+        return
+    try:
+        if _outbox_wakeup_socket is None:
+            _outbox_wakeup_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            _outbox_wakeup_socket.setblocking(False)
+        _outbox_wakeup_socket.sendto(b'1', (settings.RABBITMQ['OUTBOX_WAKEUP_HOST'], settings.RABBITMQ['OUTBOX_WAKEUP_PORT']))
+    except OSError:
+        pass
+
+
+_registered_deadletter_queue_names: set = set()    # ? Already in the DeadLetterQueue registry, per process. Saves the lookup on every outbox row.
+
+
+def register_deadletter_queue(queue_name: str, exchange_name: str = None) -> None:
+    # ? Adds the deadletter queue to the registry polled by deadletter_consumer.py, the first time this process sees it.
+    if not queue_name or queue_name in _registered_deadletter_queue_names:
+        return
+    _ = DeadLetterQueue.objects.get_or_create(queue_name=queue_name, defaults={'exchange_name': exchange_name})
+    transaction.on_commit(lambda: _registered_deadletter_queue_names.add(queue_name))    # ? Not cached if the outer transaction rolls back, the row would be gone.
+
+
+def create_queue_publish_history(
+        queue_name: str = None
+        , exchange_name: str = None
+        , deadletter_queue_name: str = None
+        , deadletter_exchange_name: str = None
+        , message_body_json: dict = None
+        , delivery_mode: int = None
+        , expiration_secs: int = None
+) -> QueuePublishHistory:
+    create_kwargs = {}
+    if delivery_mode:
+        create_kwargs['delivery_mode'] = delivery_mode
+    if expiration_secs:
+        create_kwargs['expiration_secs'] = expiration_secs
+
+    register_deadletter_queue(deadletter_queue_name, deadletter_exchange_name)
+    queue_publish_history = QueuePublishHistory.objects.create(
+                                                    queue_name=queue_name
+                                                    , exchange_name=exchange_name
+                                                    , deadletter_queue_name=deadletter_queue_name
+                                                    , deadletter_exchange_name=deadletter_exchange_name
+                                                    , message_body_json=message_body_json
+                                                    , **create_kwargs
+                                                )
+    transaction.on_commit(nudge_outbox_relay)    # ? Only once the row is visible to the relay. Runs right away outside of a transaction.
+    return queue_publish_history
 
 
 def queue_msg_to_publish(
@@ -11,21 +77,117 @@ def queue_msg_to_publish(
         , expiration_secs: int = None
 ) -> bool:
     # try:
-        create_kwargs = {}
-        if delivery_mode:
-            create_kwargs['delivery_mode'] = delivery_mode
-        if expiration_secs:
-            create_kwargs['expiration_secs'] = expiration_secs
-
-        _ = QueuePublishHistory.objects.create(
-                                        queue_name=queue_name
-                                        , exchange_name=exchange_name
-                                        , deadletter_queue_name=deadletter_queue_name
-                                        , deadletter_exchange_name=deadletter_exchange_name
-                                        , message_body_json=message_body_json
-                                        , **create_kwargs
-                                    )
+        _ = create_queue_publish_history(
+                                    queue_name=queue_name
+                                    , exchange_name=exchange_name
+                                    , deadletter_queue_name=deadletter_queue_name
+                                    , deadletter_exchange_name=deadletter_exchange_name
+                                    , message_body_json=message_body_json
+                                    , delivery_mode=delivery_mode
+                                    , expiration_secs=expiration_secs
+                                )
         return True
     # except Exception as e:
     #     # print(e)
     #     return False
+
+
+def _find_on_commit_marker(connection, on_commit_marker, marker_index: int) -> int:
+    '''
+    Index of `on_commit_marker` in `connection.run_on_commit`, -1 if Django dropped it (rolled back savepoint).
+    Checks the index it was appended at first, O(1). The list only ever loses entries before the marker on a savepoint rollback,
+    so only then the entries up to that index are scanned.
+    '''
+    run_on_commit: list = connection.run_on_commit
+    if marker_index < len(run_on_commit) and run_on_commit[marker_index][1] is on_commit_marker:
+        return marker_index
+    for index, callback in enumerate(run_on_commit[:marker_index]):
+        if callback[1] is on_commit_marker:
+            return index
+    return -1
+
+
+def queue_coalesced_msg_to_publish(coalesce_key, message_body_json: dict, merge_message_body=None, **queue_kwargs) -> bool:
+    '''
+    Same as queue_msg_to_publish(), but all the calls sharing `coalesce_key` (e.g. one model instance) within the same transaction share a single outbox row.
+    The 1st call inserts it, the next ones overwrite its body with `merge_message_body(previous_body, message_body_json)` (default: the latest body wins).
+    So the row published once the transaction commits carries the final state, and still commits / rolls back atomically with the change it describes.
+    Outside of a transaction (autocommit) every call is committed on its own, and gets its own row.
+    '''
+    connection = transaction.get_connection()
+    if not hasattr(connection, 'pending_outbox_msgs'):
+        connection.pending_outbox_msgs = {}    # ? coalesce_key -> (outbox row id, message body, on_commit marker, its index in run_on_commit), of the current transaction.
+    if not connection.in_atomic_block:
+        connection.pending_outbox_msgs.clear()    # ? Entries left over by rolled back transactions.
+
+    pending_outbox_msg = connection.pending_outbox_msgs.get(coalesce_key)
+    if pending_outbox_msg is not None:
+        queue_publish_history_id, previous_message_body, on_commit_marker, marker_index = pending_outbox_msg
+        # ? Django drops the on_commit callbacks of a rolled back (savepoint of a) transaction, along with our row. The marker still being there means the row still is.
+        marker_index = _find_on_commit_marker(connection, on_commit_marker, marker_index)
+        if marker_index >= 0:
+            if merge_message_body is not None:
+                message_body_json = merge_message_body(previous_message_body, message_body_json)
+            _ = QueuePublishHistory.objects.filter(pk=queue_publish_history_id).update(message_body_json=message_body_json)
+            connection.pending_outbox_msgs[coalesce_key] = (queue_publish_history_id, message_body_json, on_commit_marker, marker_index)
+            return True
+
+    queue_publish_history = create_queue_publish_history(message_body_json=message_body_json, **queue_kwargs)
+    if connection.in_atomic_block:
+        on_commit_marker = lambda: connection.pending_outbox_msgs.pop(coalesce_key, None)
+        marker_index: int = len(connection.run_on_commit)    # ? on_commit() appends, the marker lands at this index.
+        transaction.on_commit(on_commit_marker)
+        connection.pending_outbox_msgs[coalesce_key] = (queue_publish_history.pk, message_body_json, on_commit_marker, marker_index)
+    return True
+
+
+def archive_published_queue_history(retention_days: int = None, batch_size: int = 1000) -> int:
+    '''
+    Moves `published` rows older than `retention_days` from `queue_publish_history` into `queue_publish_history_archive`, `batch_size` rows per transaction.
+    Returns the number of rows archived.
+    '''
+    retention_days = settings.QUEUE_PUBLISH_HISTORY_RETENTION_DAYS if retention_days is None else retention_days
+    cutoff_datetime = timezone.now() - timedelta(days=retention_days)
+    field_names: list = [field.attname for field in QueuePublishHistory._meta.concrete_fields]
+
+    archived_count: int = 0
+    while True:
+        with transaction.atomic():
+            # ? Oldest first through the (status, id) index, rows are inserted in id order so the timestamps follow the ids.
+            rows: list = list(
+                            QueuePublishHistory.objects.filter(status='published', timestamp__lt=cutoff_datetime)
+                            .order_by('id')
+                            .values(*field_names)[:batch_size]
+                        )
+            if not rows:
+                break
+            _ = QueuePublishHistoryArchive.objects.bulk_create([QueuePublishHistoryArchive(**row) for row in rows])
+            _ = QueuePublishHistory.objects.filter(id__in=[row['id'] for row in rows]).delete()
+        archived_count += len(rows)
+
+    return archived_count
+
+
+def purge_processed_messages(retention_days: int = None, batch_size: int = 1000) -> int:
+    '''
+    Deletes the `processed_message` rows older than `retention_days`, `batch_size` rows per transaction.
+    Returns the number of rows deleted.
+    '''
+    retention_days = settings.PROCESSED_MESSAGE_RETENTION_DAYS if retention_days is None else retention_days
+    cutoff_datetime = timezone.now() - timedelta(days=retention_days)
+
+    purged_count: int = 0
+    while True:
+        with transaction.atomic():
+            # ? Oldest first through the primary key, rows are inserted in id order so `processed_at` follows the ids. No index needed on it.
+            message_pks: list = list(
+                                ProcessedMessage.objects.filter(processed_at__lt=cutoff_datetime)
+                                .order_by('id')
+                                .values_list('id', flat=True)[:batch_size]
+                            )
+            if not message_pks:
+                break
+            _ = ProcessedMessage.objects.filter(id__in=message_pks).delete()
+        purged_count += len(message_pks)
+
+    return purged_count
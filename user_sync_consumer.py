@@ -4,12 +4,17 @@
 import os
 import json
 import time
+import argparse
+import threading
+from functools import partial
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import django
 import pika
 from AshLogger import AshLogger
 from django.conf import settings
-from django.db import transaction
+from django.db import transaction, close_old_connections
 
 
 # Set the DJANGO_SETTINGS_MODULE environment variable to your project's settings.
@@ -17,6 +22,9 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'drf_RabbitMQ_2_proj_sync.settin
 django.setup()
 
 from users.models import UserDetail, ConflictingUserSyncLog    # Ordering of import matters, this import should be after the django.setup() call and setting the DJANGO_SETTINGS_MODULE environment variable.
+from pubsub.models import ProcessedMessage    # ? Dedup store, install the `pubsub` app in this project.
+from pubsub.codecs import decode_message_body    # ? Copy pubsub/codecs.py along with this file.
+from pubsub.routing import shard_for_key, partition_name    # ? Copy pubsub/routing.py along with this file.
 
 logger_obj = AshLogger(file_name='user_sync_consumer.log', file_location=os.path.join(settings.BASE_DIR, 'logs'), max_bytes=10000000, max_backups=1)
 ash_logger = logger_obj.setup_logger()
@@ -36,6 +44,122 @@ QUEUE_NAMES_DEADLETTER_EXCHANGE_MAPPING: dict = {
                                                 'drf_queue': 'drf_exchange_DLX'
                                             }
 
+USER_SYNC_PARTITIONS: int = int(os.environ.get('USER_SYNC_PARTITIONS', 0))    # ! Same value as settings.RABBITMQ['USER_SYNC_PARTITIONS'] of the producer project. 0: single `drf_queue`.
+USER_SYNC_CONSUME_PARTITIONS: str = os.environ.get('USER_SYNC_CONSUME_PARTITIONS', '')    # ? Comma separated partitions consumed by this process, e.g. '0,1'. Empty: all of them.
+
+
+def get_partitioned_queue_mapping(partitions: list) -> dict:
+    '''
+    `<queue>.p<k>` queues replacing the queues of QUEUE_NAMES_DEADLETTER_EXCHANGE_MAPPING. The DLX is shared by all the partitions of a queue.
+    Run one consumer per subset of partitions to scale out, a user only ever lands in one partition so its messages stay ordered.
+    '''
+    return {
+        partition_name(queue_name, partition): deadletter_exchange_name
+        for queue_name, deadletter_exchange_name in QUEUE_NAMES_DEADLETTER_EXCHANGE_MAPPING.items()
+        for partition in partitions
+    }
+
+PREFETCH_COUNT: int = int(os.environ.get('USER_SYNC_PREFETCH_COUNT', 100))    # Max. unacked messages delivered to this consumer at once.
+ACK_BATCH_SIZE: int = min(int(os.environ.get('USER_SYNC_ACK_BATCH_SIZE', 50)), PREFETCH_COUNT)    # ? Processed messages acked together with one `basic_ack(multiple=True)`. Can't exceed the prefetch window, the broker would stop delivering.
+ACK_FLUSH_INTERVAL_SECS: float = float(os.environ.get('USER_SYNC_ACK_FLUSH_INTERVAL_SECS', 1))    # Pending acks are flushed after this, even if the batch is not full (idle queue).
+
+
+class BatchedAcker:
+    '''
+    Acks the processed deliveries of a channel in bulk, with one `basic_ack(multiple=True)` for all the delivery tags up to the last processed one.
+    Safe because ack() is only called after the DB transaction of the message is committed, and the messages of a channel are processed one by one
+    in delivery tag order. So every tag up to the last acked one is committed.
+    NB: If the consumer dies, the committed but not yet acked messages (at most ACK_BATCH_SIZE) are redelivered.
+    '''
+
+    def __init__(self, channel, batch_size: int = ACK_BATCH_SIZE, flush_interval_secs: float = ACK_FLUSH_INTERVAL_SECS):
+        self.channel = channel
+        self.batch_size = batch_size
+        self.flush_interval_secs = flush_interval_secs
+        self.last_delivery_tag = None
+        self.pending_count: int = 0
+        self.flush_timer = None
+
+    def ack(self, delivery_tag: int) -> None:
+        self.last_delivery_tag = delivery_tag
+        self.pending_count += 1
+        if self.pending_count >= self.batch_size:
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = self.channel.connection.call_later(self.flush_interval_secs, self._on_flush_timer)
+
+    def _on_flush_timer(self) -> None:
+        self.flush_timer = None
+        self.flush()
+
+    def flush(self) -> None:
+        if self.flush_timer is not None:
+            self.channel.connection.remove_timeout(self.flush_timer)
+            self.flush_timer = None
+        if self.last_delivery_tag is not None and self.channel.is_open:
+            self.channel.basic_ack(delivery_tag=self.last_delivery_tag, multiple=True)    # Manually acknowledge the messages. So, that the same messages are not delivered again by the message broker and they will be removed from the queue.
+        self.last_delivery_tag = None
+        self.pending_count = 0
+
+
+USER_SYNC_WORKERS: int = int(os.environ.get('USER_SYNC_WORKERS', 1))    # ? Worker threads syncing users in parallel, see ShardedUserSyncPool. 1 processes the messages on the connection thread.
+DB_BATCH_SIZE: int = min(int(os.environ.get('USER_SYNC_DB_BATCH_SIZE', 50)), PREFETCH_COUNT)    # ? Messages written to the DB in a single transaction. 1 disables micro-batching (one transaction per message).
+DB_BATCH_MAX_WAIT_MS: int = int(os.environ.get('USER_SYNC_DB_BATCH_MAX_WAIT_MS', 200))    # A partial batch is written after this, so a lone message is not delayed for long.
+
+
+DEDUP_CACHE_SIZE: int = int(os.environ.get('USER_SYNC_DEDUP_CACHE_SIZE', 10000))    # ? Recently processed message_ids kept in memory in front of the `processed_message` table.
+
+
+class ProcessedMessageIdCache:
+    '''
+    LRU of the message_ids this process has committed (or found in ProcessedMessage). Answers the redeliveries / relay retries of a burst from memory,
+    the table is only queried for the misses. Thread safe, shared by the ShardedUserSyncPool workers.
+    '''
+
+    def __init__(self, max_size: int = DEDUP_CACHE_SIZE):
+        self.max_size = max_size
+        self.message_ids: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, message_id: str) -> bool:
+        with self.lock:
+            if message_id in self.message_ids:
+                self.message_ids.move_to_end(message_id)
+                return True
+            return False
+
+    def add(self, message_ids) -> None:
+        with self.lock:
+            for message_id in message_ids:
+                self.message_ids[message_id] = None
+                self.message_ids.move_to_end(message_id)
+            while len(self.message_ids) > self.max_size:
+                _ = self.message_ids.popitem(last=False)
+
+
+processed_message_id_cache = ProcessedMessageIdCache()
+
+
+def get_processed_message_ids(message_ids) -> set:
+    # ? The already processed ones among `message_ids`: LRU first, then one `IN` query on ProcessedMessage for the rest. Messages without a message_id are never deduplicated.
+    message_ids: set = {message_id for message_id in message_ids if message_id}
+    processed_message_ids: set = {message_id for message_id in message_ids if message_id in processed_message_id_cache}
+    unknown_message_ids: set = message_ids - processed_message_ids
+    if unknown_message_ids:
+        found_message_ids: set = set(ProcessedMessage.objects.filter(message_id__in=unknown_message_ids).values_list('message_id', flat=True))
+        processed_message_id_cache.add(found_message_ids)
+        processed_message_ids |= found_message_ids
+    return processed_message_ids
+
+
+batched_ackers: dict = {}    # ? channel number -> BatchedAcker
+
+
+def get_batched_acker(channel) -> BatchedAcker:
+    if channel.channel_number not in batched_ackers or batched_ackers[channel.channel_number].channel is not channel:
+        batched_ackers[channel.channel_number] = BatchedAcker(channel)
+    return batched_ackers[channel.channel_number]
+
 
 def sync_user_details_to_db(user_details: dict = None, exchange_name: str = None, message_id: str = None) -> None:
     if user_details:
@@ -44,6 +168,10 @@ def sync_user_details_to_db(user_details: dict = None, exchange_name: str = None
         user_details.pop('user_code', None)    # user_code is not a field in UserDetail model.
 
         with transaction.atomic():
+            if get_processed_message_ids([message_id]):
+                ash_logger.info(f" [x] Skipped duplicate msg, message_id: '{message_id}'")
+                return
+
             if is_created:    # ? If user is created then save it in DB.
                 user_already_exists = UserDetail.objects.filter(username=user_details['username'])
                 if not user_already_exists:
@@ -56,24 +184,227 @@ def sync_user_details_to_db(user_details: dict = None, exchange_name: str = None
                                                         , message_id=message_id
                                                     )
 
-            else:    # ? If user is updated then update it in DB.
-                _ = UserDetail.objects.filter(username=user_details['username']).update(**user_details)
+            else:    # ? If user is updated then update it in DB. Diff payloads only carry the changed fields, applied as a partial update of the user they had before a rename.
+                lookup_username = user_details.pop('lookup_username', None) or user_details['username']
+                user_details.pop('id', None)    # ? Matched by username, the pk is never changed. Same as the batched path.
+                _ = UserDetail.objects.filter(username=lookup_username).update(**user_details)
+
+            if message_id:
+                _ = ProcessedMessage.objects.create(message_id=message_id)    # ? Same transaction, a message is either applied and recorded or neither. A concurrent duplicate fails on the unique index and rolls back.
+        if message_id:
+            processed_message_id_cache.add([message_id])    # * Only after the commit.
+
+
+def sync_user_details_batch_to_db(messages: list) -> None:
+    '''
+    Same as sync_user_details_to_db() but for a whole micro-batch of messages [(user_details, exchange_name, message_id), ...], in delivery order, in one transaction:
+        - All the usernames are resolved with one `IN` query.
+        - New users are inserted with one `bulk_create`. An update following the create of the same user in the batch is folded into the row to insert.
+        - Updates (full rows or diffs, looked up by `lookup_username` if renamed) are merged per user (later messages win) and written with one `bulk_update` per set of updated fields.
+        - Conflicts are inserted with one `bulk_create` into ConflictingUserSyncLog.
+        - Already processed message_ids (LRU, then one `IN` query on ProcessedMessage) are dropped, the applied ones are recorded with one `bulk_create`.
+    '''
+    if not messages:
+        return
+
+    users_to_create: dict = {}    # username -> user_details
+    users_to_update: dict = {}    # pk -> (user, merged user_details)
+    conflicting_user_sync_logs: list = []
+    applied_message_ids: list = []
+    duplicate_count: int = 0
+
+    usernames: set = {user_details.get('lookup_username') or user_details['username'] for user_details, _, _ in messages}
+    with transaction.atomic():
+        existing_users: dict = {user.username: user for user in UserDetail.objects.filter(username__in=usernames).only('id', 'username')}
+        processed_message_ids: set = get_processed_message_ids(message_id for _, _, message_id in messages)
+
+        for user_details, exchange_name, message_id in messages:
+            if message_id in processed_message_ids:    # ? Also catches a message redelivered twice within this batch.
+                duplicate_count += 1
+                continue
+            if message_id:
+                processed_message_ids.add(message_id)
+                applied_message_ids.append(message_id)
+
+            is_created = user_details.pop('is_created', None)
+            user_details.pop('college_id', None)    # college_id is not a field in UserDetail model.
+            user_details.pop('user_code', None)    # user_code is not a field in UserDetail model.
+            username = user_details.pop('lookup_username', None) or user_details['username']    # ? The username before a rename, for diff payloads.
+
+            if is_created:    # ? If user is created then save it in DB.
+                if username in existing_users or username in users_to_create:
+                    conflicting_user_sync_logs.append(ConflictingUserSyncLog(
+                                                        raw_message_body_json=json.dumps(user_details)
+                                                        , comment='User already exists in DB.'
+                                                        , exchange_name=exchange_name
+                                                        , message_id=message_id
+                                                    ))
+                else:
+                    users_to_create[username] = user_details
+            elif username in users_to_create:    # ? Created earlier in this same batch, not in the DB yet.
+                users_to_create[username].update(user_details)
+                users_to_create[user_details['username']] = users_to_create[username]    # ? Renamed, later messages look it up by the new username.
+            elif username in existing_users:    # ? If user is updated then update it in DB. (Unknown usernames are skipped, same as `.filter().update()`.)
+                user = existing_users[username]
+                users_to_update.setdefault(user.pk, (user, {}))[1].update(user_details)
+                existing_users[user_details['username']] = user    # ? Renamed, later messages look it up by the new username.
+
+        if users_to_create:
+            _ = UserDetail.objects.bulk_create([UserDetail(**user_details) for user_details in {id(user_details): user_details for user_details in users_to_create.values()}.values()])    # ? A renamed user is in there under both names.
+
+        # * Users updated with the same set of fields (the usual case, full snapshots) are written together with one bulk_update. Rows are matched by username, the pk is never changed.
+        users_by_updated_fields: dict = {}
+        for user, user_details in users_to_update.values():
+            user_details.pop('id', None)
+            for field_name, value in user_details.items():
+                setattr(user, field_name, value)
+            users_by_updated_fields.setdefault(tuple(sorted(user_details)), []).append(user)
+        for updated_fields, users in users_by_updated_fields.items():
+            _ = UserDetail.objects.bulk_update(users, list(updated_fields))
+
+        if conflicting_user_sync_logs:
+            _ = ConflictingUserSyncLog.objects.bulk_create(conflicting_user_sync_logs)
+
+        if applied_message_ids:
+            _ = ProcessedMessage.objects.bulk_create([ProcessedMessage(message_id=message_id) for message_id in applied_message_ids])
+    processed_message_id_cache.add(applied_message_ids)    # * Only after the commit.
+    if duplicate_count:
+        ash_logger.info(f" [x] Skipped {duplicate_count} duplicate msgs of the batch.")
+
+
+class UserSyncMicroBatcher:
+    '''
+    Collects the messages of a channel until DB_BATCH_SIZE messages or DB_BATCH_MAX_WAIT_MS, then writes them in one transaction
+    (sync_user_details_batch_to_db) and acks them together with one `basic_ack(multiple=True)` after the commit.
+    If the batch fails, its messages are retried one by one, so a single bad message does not block the others.
+    '''
+
+    def __init__(self, channel, batch_size: int = DB_BATCH_SIZE, max_wait_ms: int = DB_BATCH_MAX_WAIT_MS):
+        self.channel = channel
+        self.batch_size = batch_size
+        self.max_wait_ms = max_wait_ms
+        self.pending_messages: list = []    # [(delivery_tag, user_details, exchange_name, message_id), ...]
+        self.flush_timer = None
+
+    def add(self, delivery_tag: int, user_details: dict, exchange_name: str, message_id: str) -> None:
+        self.pending_messages.append((delivery_tag, user_details, exchange_name, message_id))
+        if len(self.pending_messages) >= self.batch_size:
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = self.channel.connection.call_later(self.max_wait_ms / 1000, self._on_flush_timer)
+
+    def _on_flush_timer(self) -> None:
+        self.flush_timer = None
+        self.flush()
+
+    def flush(self) -> None:
+        if self.flush_timer is not None:
+            self.channel.connection.remove_timeout(self.flush_timer)
+            self.flush_timer = None
+        pending_messages, self.pending_messages = self.pending_messages, []
+        if not pending_messages:
+            return
+
+        batched_acker = get_batched_acker(self.channel)
+        try:
+            sync_user_details_batch_to_db([(dict(user_details), exchange_name, message_id) for _, user_details, exchange_name, message_id in pending_messages])
+        except Exception as e:
+            ash_logger.info(f"Batch of {len(pending_messages)} msgs failed, retrying them one by one -----> {str(e)}")
+            for delivery_tag, user_details, exchange_name, message_id in pending_messages:
+                try:
+                    _ = sync_user_details_to_db(user_details, exchange_name, message_id)
+                except Exception:
+                    batched_acker.flush()    # ? Ack the messages committed before this one, so only this one and the next ones are redelivered after the reconnect.
+                    raise
+                batched_acker.ack(delivery_tag)
+        else:
+            ash_logger.info(f" [x] Synced batch of {len(pending_messages)} msgs, delivery tags: {pending_messages[0][0]}..{pending_messages[-1][0]}")
+            batched_acker.ack(pending_messages[-1][0])
+        batched_acker.flush()
+
+
+user_sync_micro_batchers: dict = {}    # ? channel number -> UserSyncMicroBatcher
+
+
+def get_user_sync_micro_batcher(channel) -> UserSyncMicroBatcher:
+    if channel.channel_number not in user_sync_micro_batchers or user_sync_micro_batchers[channel.channel_number].channel is not channel:
+        user_sync_micro_batchers[channel.channel_number] = UserSyncMicroBatcher(channel)
+    return user_sync_micro_batchers[channel.channel_number]
+
+
+class ShardedUserSyncPool:
+    '''
+    N worker threads, each one with its own DB connection (Django connections are per thread). A message goes to the worker picked by a stable hash
+    of its user `id` (the publisher's pk, in full and diff payloads), and every worker applies its messages one by one, in delivery order.
+    Not the username, a rename would send the next messages of the user to another worker and they could overtake the rename.
+    So the messages of a user stay ordered while different users are synced in parallel.
+    pika channels are not thread safe, the workers hand the result back to the connection thread with `add_callback_threadsafe()`. As the deliveries
+    complete out of order, they are acked one by one.
+    A failed message is retried by its worker until it goes through, never rejected: a dead-lettered message would be republished by the relay
+    after the later messages of the same user, and an older snapshot would overwrite the newer state. The shard waits meanwhile, the other ones go on.
+    '''
+
+    def __init__(self, worker_count: int = USER_SYNC_WORKERS):
+        self.executors: list = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'user-sync-worker-{i}') for i in range(worker_count)]
+
+    def submit(self, ch, delivery_tag: int, user_details: dict, exchange_name: str, message_id: str) -> None:
+        shard_key = user_details.get('id') or user_details.get('lookup_username') or user_details.get('username')    # ? Username only for messages published before `id` was in diffs.
+        executor = self.executors[shard_for_key(shard_key, len(self.executors))]
+        _ = executor.submit(self._sync, ch, delivery_tag, user_details, exchange_name, message_id)
+
+    def _sync(self, ch, delivery_tag: int, user_details: dict, exchange_name: str, message_id: str) -> None:
+        retry_in_secs: float = 0.5
+        while True:
+            close_old_connections()    # ? Drops this worker's DB connection if it went stale (MySQL wait_timeout, restart), a new one is opened by the next query.
+            try:
+                _ = sync_user_details_to_db(dict(user_details), exchange_name, message_id)    # ? A copy, the sync pops keys and a retry needs them all.
+            except Exception as e:
+                # ? Rolled back as a whole, retrying is safe. Also after the commit of a previous attempt, the message_id is then found processed.
+                ash_logger.info(f"Error while syncing msg with delivery tag {delivery_tag}, message_id: '{message_id}', retrying in {retry_in_secs}s -----> {str(e)}")
+                time.sleep(retry_in_secs)
+                retry_in_secs = min(retry_in_secs * 2, SLEEP_INTERVAL)
+                continue
+            break
+        ash_logger.info(f" [x] Synced msg with delivery tag {delivery_tag}, message_id: '{message_id}'")
+        try:
+            ch.connection.add_callback_threadsafe(partial(self._ack, ch, delivery_tag))
+        except pika.exceptions.ConnectionWrongStateError:
+            pass    # ? Connection closed meanwhile, the message is redelivered on the new one and dropped as already processed.
+
+    @staticmethod
+    def _ack(ch, delivery_tag: int) -> None:
+        if not ch.is_open:
+            return    # ? Channel lost meanwhile, the broker redelivers the message on the new one, where it is dropped as already processed.
+        ch.basic_ack(delivery_tag=delivery_tag)
+
+
+user_sync_pool = None    # ? ShardedUserSyncPool, started in __main__ when USER_SYNC_WORKERS > 1.
 
 
 # * Callback function to handle incoming messages.
 def callback(ch, method, properties, body):
 
     print()
-    message_body_str = body.decode('utf-8')    # bytes to str convert with "" in beginning and end.
-    message_body_str = json.loads(message_body_str)    # str to str convert but removed "" in the beginning and end.
-    message_body_dict = json.loads(message_body_str)    # str to dict convert.
+    message_body_dict = decode_message_body(body, properties.content_type)    # * Single pass, bytes to dict. Also handles the legacy double encoded JSON bodies still in the queue.
 
-    _ = sync_user_details_to_db(message_body_dict, method.exchange, properties.message_id)
+    if user_sync_pool is not None:
+        user_sync_pool.submit(ch, method.delivery_tag, message_body_dict, method.exchange, properties.message_id)    # * Synced & acked by a worker thread.
+        return
+
+    if DB_BATCH_SIZE > 1:
+        get_user_sync_micro_batcher(ch).add(method.delivery_tag, message_body_dict, method.exchange, properties.message_id)    # * Written & acked with the rest of its batch.
+        return
+
+    try:
+        _ = sync_user_details_to_db(message_body_dict, method.exchange, properties.message_id)
+    except Exception:
+        get_batched_acker(ch).flush()    # ? Ack the messages committed before this one, so only this one is redelivered after the reconnect.
+        raise
 
     # print(f" [x] Received msg: {body}, of type: {type(body)}")
     ash_logger.info(f" [x] Received msg: {body}, of type: {type(body)}")
 
-    ch.basic_ack(delivery_tag=method.delivery_tag)    # Manually acknowledge the message. So, that the same message is not delivered again by the message broker and it will be removed from the queue.
+    get_batched_acker(ch).ack(method.delivery_tag)    # * Acked in bulk with the next ones, only after the DB commit above.
     # ch.basic_reject(delivery_tag = method.delivery_tag, requeue=True)    # Manually reject the message.
 
 
@@ -129,14 +460,13 @@ def consume_msg_from_rabbitmq():
 
 
         '''
-        Consumer will only consume 1 message at a time. 
         It is the maximum number of unacknowledged messages (or "unacked" messages) that a consumer can receive from a queue at a time.
         It sets a "quality of service" (QoS) limit for message consumption.
         Setting prefetch_count=1 ensures that each consumer receives one message at a time, allowing for a fair distribution of messages among multiple consumers.
-        This is especially useful when you have multiple consumers (workers) competing for messages from the same queue.
-        It prevents one consumer from hogging all the messages while others remain idle.
+        But it also caps the throughput at one broker round trip per message. With a window of PREFETCH_COUNT messages, the next messages are already
+        buffered locally while the current one is written to the DB, and the acks can be batched (see BatchedAcker).
         '''
-        channel.basic_qos(prefetch_count=1)
+        channel.basic_qos(prefetch_count=PREFETCH_COUNT)
 
 
         # * Set up a consumer to listen for messages in the `queue_name` queue
@@ -162,6 +492,19 @@ def consume_msg_from_rabbitmq():
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Consumes the user sync messages and writes them to the DB.')
+    parser.add_argument('--workers', type=int, default=USER_SYNC_WORKERS, help='Worker threads, messages are sharded by user id so each user stays ordered.')
+    parser.add_argument('--partitions', default=USER_SYNC_CONSUME_PARTITIONS, help=f'Comma separated partitions to consume, out of the {USER_SYNC_PARTITIONS} USER_SYNC_PARTITIONS. Default: all.')
+    args = parser.parse_args()
+    if USER_SYNC_PARTITIONS:
+        consumed_partitions: list = [int(partition) for partition in args.partitions.split(',') if partition.strip()] or list(range(USER_SYNC_PARTITIONS))
+        assert all(0 <= partition < USER_SYNC_PARTITIONS for partition in consumed_partitions), f'Partitions must be in [0, {USER_SYNC_PARTITIONS}).'
+        QUEUE_NAMES_DEADLETTER_EXCHANGE_MAPPING = get_partitioned_queue_mapping(consumed_partitions)
+        ash_logger.info(f' [*] Consuming partitions {consumed_partitions} of {USER_SYNC_PARTITIONS}.')
+    if args.workers > 1:
+        user_sync_pool = ShardedUserSyncPool(args.workers)
+        ash_logger.info(f' [*] Syncing users with {args.workers} worker threads.')
+
     while True:
         connection = consume_msg_from_rabbitmq()
         if connection:
@@ -1,4 +1,6 @@
-from django.db import models
+import threading
+
+from django.db import models, connections, transaction, IntegrityError, DEFAULT_DB_ALIAS
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 import drf_signal_simplejwt.base_functions as base_f
@@ -9,21 +11,92 @@ from auditlog.registry import auditlog
 from auditlog.models import AuditlogHistoryField
 
 
-# Timestamp is always unique. Though the below code is not timestamp.
+USER_CODE_PREFIX: str = 'UC'
+USER_CODE_WIDTH: int = 4    # ? Min. digits, zero padded. Codes simply grow wider past UC9999.
+
+
+class UserCodeAllocator:
+    '''
+    Hands out the `user_code`s from blocks of `block_size` values, reserved in UserCodeSequence with one atomic `UPDATE ... SET next_value = next_value + block_size`.
+    So a new user costs no query for its code (one per block), and parallel creates (threads, processes, hosts, bulk_create) never get the same code.
+    Blocks are reserved on a dedicated DB connection and committed right away: a rolled back user create must not give its block back, as the codes
+    already handed out of it would be handed out again. The unused codes of a block are lost when the process exits (gaps, never duplicates).
+    '''
+    sequence_name: str = 'user_code'
+
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.next_value: int = 0
+        self.block_end: int = 0    # Exclusive.
+        self.db_connection = None
+
+    def allocate(self) -> str:
+        with self.lock:
+            if self.next_value >= self.block_end:
+                self.next_value = self._reserve_block()
+                self.block_end = self.next_value + self.block_size
+            value = self.next_value
+            self.next_value += 1
+        return f'{USER_CODE_PREFIX}{value:0{USER_CODE_WIDTH}d}'
+
+    def _reserve_block(self) -> int:
+        default_connection = connections[DEFAULT_DB_ALIAS]
+        if default_connection.vendor == 'sqlite' and default_connection.is_in_memory_db():
+            with transaction.atomic():    # ? A 2nd connection would open another, empty in-memory DB (tests / benchmarks). No other process to race with anyway.
+                return self._increment(default_connection)
+
+        for attempt in range(2):    # ? 2nd attempt only if another process created the sequence row at the same moment.
+            if self.db_connection is None:
+                self.db_connection = connections.create_connection(DEFAULT_DB_ALIAS)
+                self.db_connection.inc_thread_sharing()    # ? Used by whichever thread runs out of codes, always under self.lock.
+            self.db_connection.close_if_unusable_or_obsolete()
+            try:
+                self.db_connection.set_autocommit(False)
+                first_value = self._increment(self.db_connection)
+                self.db_connection.commit()
+                self.db_connection.set_autocommit(True)
+                return first_value
+            except IntegrityError:
+                self.db_connection.rollback()
+                self.db_connection.set_autocommit(True)
+                if attempt:
+                    raise
+            except Exception:
+                self.db_connection.close()    # ? Broken / stale connection, a new one is opened for the next block.
+                self.db_connection = None
+                raise
+
+    def _increment(self, db_connection) -> int:
+        # ? Returns the first value of the reserved block. The UPDATE row lock serializes the reservations, it is held only until the commit of this tiny transaction.
+        table_name: str = db_connection.ops.quote_name(UserCodeSequence._meta.db_table)
+        with db_connection.cursor() as cursor:
+            cursor.execute(f'UPDATE {table_name} SET next_value = next_value + %s WHERE name = %s', [self.block_size, self.sequence_name])
+            if cursor.rowcount:
+                cursor.execute(f'SELECT next_value FROM {table_name} WHERE name = %s', [self.sequence_name])
+                return cursor.fetchone()[0] - self.block_size
+
+            first_value: int = self._get_first_value_after_existing_codes()    # * 1st use, carries on after the codes generated before this table existed.
+            cursor.execute(f'INSERT INTO {table_name} (name, next_value) VALUES (%s, %s)', [self.sequence_name, first_value + self.block_size])
+            return first_value
+
+    @staticmethod
+    def _get_first_value_after_existing_codes() -> int:
+        # ? One off scan, when the sequence row is created.
+        last_value: int = 0
+        for user_code in UserDetail.objects.filter(user_code__startswith=USER_CODE_PREFIX).values_list('user_code', flat=True).iterator():
+            code_number: str = user_code[len(USER_CODE_PREFIX):]
+            if code_number.isdigit():
+                last_value = max(last_value, int(code_number))
+        return last_value + 1
+
+
+user_code_allocator = UserCodeAllocator(block_size=settings.USER_CODE_BLOCK_SIZE)
+
+
 def return_timestamped_user_code():
-        last_user_code = UserDetail.objects.all().order_by('id').last()
-        # import pdb; pdb.set_trace()
-        if not last_user_code:
-            return 'UC0001'
-        else:
-            timestamped_id = last_user_code.user_code
-            timestamped_id = int(timestamped_id.split('UC')[-1])
-            width = 4
-            new_unique_int = timestamped_id + 1
-            formatted = (width - len(str(new_unique_int))) * "0" + str(new_unique_int)
-            new_unique_id = 'UC' + str(formatted)
-            # print('new_unique_id-------->', new_unique_id)
-            return new_unique_id
+    # ? Default of `UserDetail.user_code`, kept under this name as the migrations reference it.
+    return user_code_allocator.allocate()
 
 
 class UserDetail(AbstractUser):
@@ -127,6 +200,21 @@ auditlog.register(UserDetail)
 
 
 
+'''
+Purpose: Counters handed out in blocks by UserCodeAllocator. `next_value` is the first value not reserved by any process yet.
+'''
+class UserCodeSequence(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    next_value = models.BigIntegerField(default=1)
+
+    def __str__(self):
+        return f'{self.name}: {self.next_value}'
+
+    class Meta:
+        db_table = 'user_code_sequence'
+
+
+
 class UserLog(models.Model):
     user_details = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, blank=True, null=True, related_name='log_user_details')
     comment = models.TextField(blank=True, null=True)
@@ -148,7 +236,7 @@ class UserAPIHitLog(models.Model):
     external_ip = models.GenericIPAddressField()
     browser_name = models.CharField(max_length=255)
     os_name = models.CharField(max_length=255)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)    # ? Not auto_now_add, which would stamp the time of the buffered bulk insert instead of the time of the hit.
 
     def __str__(self):
         return f"{self.user.username} - {self.api_name} - {self.timestamp}"
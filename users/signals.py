@@ -1,7 +1,5 @@
-from copy import deepcopy
 from pprint import pprint
 from django.conf import settings
-from django.db import transaction
 from django.db.models.signals import (
     pre_save          # ? Before saving a model instance (create/update).
     , post_save       # ? After saving a model instance (create/update).
@@ -16,7 +14,53 @@ from django.db.models.signals import (
 )
 from django.dispatch import receiver
 from .models import UserDetail, UserLog
-from pubsub.utils import queue_msg_to_publish
+from pubsub.utils import queue_coalesced_msg_to_publish
+from drf_signal_simplejwt.base_functions import get_field_extractor
+from pubsub.routing import shard_for_key, partition_name
+
+
+get_loaded_user_field_values = get_field_extractor(UserDetail)    # ? Flat dict of the loaded field values of a user, `college_id` and not `college`.
+
+
+@receiver(post_init, sender=UserDetail)
+def track_user_original_field_values(sender, instance, **kwargs):
+    # * 'diff' payload mode: field values as loaded from the DB, the next save only publishes the fields changed since.
+    if settings.RABBITMQ['USER_SYNC_PAYLOAD_MODE'] == 'diff':
+        instance._user_sync_original_values = get_loaded_user_field_values(instance)
+
+
+def get_user_sync_diff_message_body(instance) -> dict:
+    '''
+    Changed fields of an updated user, plus `id` (the shard key of the consumer workers, it never changes), `username` (its new value)
+    and `lookup_username` (the username the consumer knows it by, before a rename).
+    Returns an empty dict if nothing changed. The current values become the new originals, so a 2nd save only ships what changed after the 1st one.
+    '''
+    original_values: dict = instance._user_sync_original_values
+    current_values: dict = get_loaded_user_field_values(instance)
+    instance._user_sync_original_values = current_values
+    changed_values: dict = {attname: value for attname, value in current_values.items() if attname not in original_values or original_values[attname] != value}
+    if not changed_values:
+        return {}
+    return {
+        **changed_values
+        , 'id': instance.pk
+        , 'username': instance.username
+        , 'lookup_username': original_values.get('username', instance.username)
+        , 'is_created': False
+    }
+
+
+def merge_user_sync_message_body(previous_message_body: dict, message_body: dict) -> dict:
+    '''
+    Latest values win. Diffs add up, and a user created earlier in the same transaction must still reach the consumer as created (with its full row).
+    The consumer must look the user up by the username it had before the 1st save of the transaction.
+    '''
+    merged_message_body: dict = {**previous_message_body, **message_body, 'is_created': previous_message_body['is_created'] or message_body['is_created']}
+    if 'lookup_username' in previous_message_body:
+        merged_message_body['lookup_username'] = previous_message_body['lookup_username']
+    if merged_message_body['is_created']:
+        merged_message_body.pop('lookup_username', None)
+    return merged_message_body
 
 
 # ! Signal (3/3) - Add this funciton. This function will be called when a UserDetail instance is created
@@ -31,25 +75,38 @@ def create_entry_queue_publish_history_user_post_creation(sender, instance, crea
     kwargs: {'signal': <django.db.models.signals.ModelSignal object at 0x0000012345678950>, 'update_fields': None, 'raw': False, 'using': 'default'}
     '''
 
-    copied_user_instance_dict: dict = deepcopy(instance.__dict__)
-    copied_user_instance_dict.pop('_state', None)
-    copied_user_instance_dict.pop('_django_version', None)
-
-    if created:    # ? User is created.
-        # If a new UserDetail instance is created, create a new Log instance
-        copied_user_instance_dict.update(is_created=True)
-    else:          # ? User is updated.
-        copied_user_instance_dict.update(is_created=False)
-
-    with transaction.atomic():
-        status: bool = queue_msg_to_publish(
-                                queue_name=settings.RABBITMQ['USER_SYNC_QUEUE_NAME']
-                                , exchange_name=settings.RABBITMQ['USER_SYNC_EXCHANGE_NAME']
-                                , deadletter_queue_name=settings.RABBITMQ['USER_SYNC_QUEUE_NAME'] + '_DLQ'
-                                , deadletter_exchange_name=settings.RABBITMQ['USER_SYNC_EXCHANGE_NAME'] + '_DLX'
-                                , message_body_json=copied_user_instance_dict
-                                # , expiration_secs=10    # * For testing purpose only.
-                    )
+    if not created and hasattr(instance, '_user_sync_original_values'):    # ? 'diff' payload mode, see track_user_original_field_values().
+        copied_user_instance_dict: dict = get_user_sync_diff_message_body(instance)
+        if not copied_user_instance_dict:
+            return    # * Saved without any change, nothing to sync.
+    else:
+        copied_user_instance_dict: dict = get_loaded_user_field_values(instance)    # * Instead of deepcopy(instance.__dict__) minus `_state` & co.
+
+        if created:    # ? User is created.
+            # If a new UserDetail instance is created, create a new Log instance
+            copied_user_instance_dict.update(is_created=True)
+            if settings.RABBITMQ['USER_SYNC_PAYLOAD_MODE'] == 'diff':
+                instance._user_sync_original_values = get_loaded_user_field_values(instance)    # ? Later saves of this instance publish their diff.
+        else:          # ? User is updated.
+            copied_user_instance_dict.update(is_created=False)
+
+    queue_name: str = settings.RABBITMQ['USER_SYNC_QUEUE_NAME']
+    exchange_name: str = settings.RABBITMQ['USER_SYNC_EXCHANGE_NAME']
+    if settings.RABBITMQ['USER_SYNC_PARTITIONS']:    # ? Every message of a user goes to the same partition, so it is consumed in order.
+        partition: int = shard_for_key(instance.pk, settings.RABBITMQ['USER_SYNC_PARTITIONS'])    # ? pk instead of username, it never changes.
+        queue_name, exchange_name = partition_name(queue_name, partition), partition_name(exchange_name, partition)
+
+    # * All the saves of this user within the current transaction (e.g. create + set_password() in ListCreateUserSerializer) share one outbox row, carrying the final state.
+    status: bool = queue_coalesced_msg_to_publish(
+                            coalesce_key=(sender._meta.label, instance.pk)
+                            , message_body_json=copied_user_instance_dict
+                            , merge_message_body=merge_user_sync_message_body
+                            , queue_name=queue_name
+                            , exchange_name=exchange_name
+                            , deadletter_queue_name=settings.RABBITMQ['USER_SYNC_QUEUE_NAME'] + '_DLQ'
+                            , deadletter_exchange_name=settings.RABBITMQ['USER_SYNC_EXCHANGE_NAME'] + '_DLX'
+                            # , expiration_secs=10    # * For testing purpose only.
+                )
 
 
 """